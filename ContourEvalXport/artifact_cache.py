@@ -0,0 +1,103 @@
+""" In-process cache of per-image artifacts (decoded images, labelled ground truth, argmax class maps and predictor
+outputs), so each artifact is computed once per process even when several scripts or predictor configurations ask
+for it.
+
+Entries are keyed by the artifact kind, the file it comes from, the modification time of that file and any extra
+parameters, so an edited file is never served from the cache. The least recently used entries are evicted when the
+total size of the cached arrays goes above the memory cap. Cached arrays are shared by every caller; copy them before
+modifying.
+"""
+
+import io
+import os
+import contextlib
+import collections
+import numpy as np
+
+import instrumentation
+import packed_dataset
+
+DEFAULT_MAX_BYTES = 512 * 2 ** 20
+
+
+class ArtifactCache:
+    """ LRU cache of numpy arrays with a memory cap in bytes """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """ Returns the cached value for 'key', computing it with 'compute()' when it is missing """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        value = compute()
+        size = value.nbytes if isinstance(value, np.ndarray) else 0
+        if size > self.max_bytes:
+            return value
+
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes if isinstance(evicted, np.ndarray) else 0
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+# Cache shared by all the scripts of the package
+CACHE = ArtifactCache()
+# Contents of png files read ahead of their decoding (see pipeline.py), keyed by path
+_prefetched = {}
+
+
+def file_key(kind, path, *params):
+    """ Cache key of an artifact computed from the file at 'path' (or the image of a packed dataset) """
+    if isinstance(path, packed_dataset.PackedImage):
+        return kind, path.key(), params
+    return kind, os.path.abspath(path), os.stat(path).st_mtime_ns, params
+
+
+def is_file(image):
+    """ Whether 'image' refers to an image on disk (a path or the image of a packed dataset) rather than an array """
+    return isinstance(image, (str, packed_dataset.PackedImage))
+
+
+def read_image(path):
+    """ Decoded image at 'path'. Images of packed datasets are memory-mapped views, which are not cached """
+    if isinstance(path, packed_dataset.PackedImage):
+        return path.load()
+    return CACHE.get(file_key("image", path), lambda: decode_image(path))
+
+
+@instrumentation.timed("decode")
+def decode_image(path):
+    # skimage.io is slow to import and only needed for png files; packed datasets and arrays never load it
+    import skimage.io
+    contents = _prefetched.pop(path, None)
+    if contents is not None:
+        return skimage.io.imread(io.BytesIO(contents))
+    return skimage.io.imread(path)
+
+
+@contextlib.contextmanager
+def prefetched(contents):
+    """ Within the block, the files of 'contents' (their contents keyed by path) are decoded from memory instead of
+    being read from the disk again
+    """
+    _prefetched.update(contents)
+    try:
+        yield
+    finally:
+        for path in contents:
+            _prefetched.pop(path, None)
@@ -0,0 +1,370 @@
+""" Benchmark suite of the predictors and the evaluation metrics. Every case is timed on synthetic class images of
+growing size and nuclei density, and on the images of a real dataset (SmallEval by default). The synthetic images
+draw nuclei around random seeds with an interior, a one or two pixel boundary and background, and encode the three
+planes as uint8 probabilities like the U-Net output in the Classes directory; their ground truth is the nuclei that
+were drawn.
+
+For each case the suite reports the best wall time, the peak memory allocated during one run (measured with
+tracemalloc in a separate, untimed run) and the throughput in megapixels per second. The results can be saved as
+JSON and compared with the JSON of an earlier run, so regressions show up before they ship.
+
+The start-up cases run in new Python processes: importing each module of the package, and predicting a 256 x 256
+crop from scratch as a per-tile job would. Their peak is the resident memory of the process, and they list the slow
+dependencies the process imported.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import argparse
+import datetime
+import tracemalloc
+import contextlib
+import numpy as np
+import scipy.ndimage
+import skimage.segmentation
+from prettytable import PrettyTable
+
+import artifact_cache
+import predictors as pred
+import propagation
+import shared_resources as shres
+import show_eval as eval
+
+# Dense IoU arrays larger than this number of entries are not benchmarked
+DENSE_IOU_MAX_ENTRIES = 2 * 10 ** 7
+# Modules whose import time is measured by default
+STARTUP_MODULES = ["shared_resources", "predictors", "show_eval", "evaluate_new_method", "predictor_service"]
+# Dependencies that are slow to import. The start-up cases report which of them they loaded
+SLOW_MODULES = ["scipy.ndimage", "scipy.sparse", "skimage.io", "skimage.morphology", "pandas", "matplotlib.pyplot",
+                "prettytable", "numba"]
+# Appended to the code of the start-up cases to print the peak resident memory and the slow modules imported. The
+# peak is read from /proc on Linux because ru_maxrss would include the memory of the benchmark process, which the
+# new process was forked from (ru_maxrss is in bytes on macOS)
+STARTUP_REPORT = """
+import sys, json, resource
+try:
+    peak = [int(line.split()[1]) * 1024 for line in open("/proc/self/status") if line.startswith("VmHWM")][0]
+except OSError:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([peak, [name for name in {!r} if name in sys.modules]]))
+"""
+
+
+def parse_arguments():
+    describe = "Measures the runtime, peak memory and throughput of the predictors and the evaluation metrics"
+    parser = argparse.ArgumentParser(description=describe)
+
+    help_s = "Image sizes (height = width) of the synthetic images"
+    parser.add_argument("-s", "--sizes", help=help_s, type=int, nargs="+", required=False,
+                        default=[256, 512, 1024, 2048, 4096])
+
+    help_k = "Nuclei per megapixel of the synthetic images"
+    parser.add_argument("-k", "--densities", help=help_k, type=int, nargs="+", required=False, default=[900])
+
+    help_e = "Propagation engines of the pixel method to measure"
+    parser.add_argument("-e", "--engines", help=help_e, type=str, nargs="+", required=False,
+                        default=list(propagation.ENGINES.keys()))
+
+    help_pa = "Pass counts of the pixel method to measure, besides running it to convergence"
+    parser.add_argument("-pa", "--passes", help=help_pa, type=int, nargs="*", required=False, default=[1, 5])
+
+    help_m = "Largest image size measured with the python engine, which visits every pixel in Python"
+    parser.add_argument("-m", "--python_max_size", help=help_m, type=int, required=False, default=512)
+
+    help_r = "Root directory of the real dataset to measure. Use an empty string to skip it"
+    parser.add_argument("-r", "--root_dir", help=help_r, type=str, required=False, default="SmallEval")
+
+    help_n = "Number of repetitions; the best time is reported"
+    parser.add_argument("-n", "--repeat", help=help_n, type=int, required=False, default=3)
+
+    help_d = "Seed of the synthetic images"
+    parser.add_argument("-d", "--seed", help=help_d, type=int, required=False, default=0)
+
+    help_i = "Modules whose import time is measured in a new process. Give no module to skip the start-up cases"
+    parser.add_argument("-i", "--imports", help=help_i, type=str, nargs="*", required=False, default=STARTUP_MODULES)
+
+    help_j = "JSON file where the results are saved"
+    parser.add_argument("-j", "--json_file", help=help_j, type=str, required=False, default=None)
+
+    help_b = "JSON file of an earlier run to compare the results with"
+    parser.add_argument("-b", "--baseline_file", help=help_b, type=str, required=False, default=None)
+
+    help_t = "Relative slowdown (or growth of peak memory) above which a case is reported as a regression"
+    parser.add_argument("-t", "--tolerance", help=help_t, type=float, required=False, default=0.2)
+    args = parser.parse_args()
+    return {"sizes": args.sizes,
+            "densities": args.densities,
+            "engines": args.engines,
+            "passes": args.passes,
+            "python_max_size": args.python_max_size,
+            "root_dir": args.root_dir,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "imports": args.imports,
+            "json_file": args.json_file,
+            "baseline_file": args.baseline_file,
+            "tolerance": args.tolerance}
+
+
+def synthetic_sample(height, width, nuclei_per_megapixel=900, seed=0):
+    """ Returns a height x width x 3 uint8 class image with background, interior and boundary planes, and the
+    sequentially labelled ground truth of the nuclei drawn in it
+    """
+    rng = np.random.default_rng(seed)
+    num_nuclei = max(1, int(nuclei_per_megapixel * height * width / 1e6))
+    seeds = np.ones((height, width), dtype=bool)
+    seeds[rng.integers(0, height, num_nuclei), rng.integers(0, width, num_nuclei)] = False
+    radii = rng.uniform(6, 12, num_nuclei + 1)
+
+    # Every pixel is assigned to its nearest seed; the distance to it decides the class of the pixel
+    distance, indices = scipy.ndimage.distance_transform_edt(seeds, return_indices=True)
+    nearest = indices[0] * width + indices[1]
+    _, owner = np.unique(nearest, return_inverse=True)
+    owner = owner.reshape(height, width)
+    radius = radii[owner]
+
+    classes = np.zeros((height, width), dtype=np.uint8)
+    classes[distance < radius] = 2
+    classes[distance < radius - 2] = 1
+
+    # Interior pixels where two nuclei meet become boundary
+    touching = scipy.ndimage.maximum_filter(owner, size=3) != scipy.ndimage.minimum_filter(owner, size=3)
+    classes[touching & (classes == 1)] = 2
+
+    class_image = rng.integers(0, 60, (height, width, 3), dtype=np.uint8)
+    np.put_along_axis(class_image, classes[:, :, None], 200, axis=-1)
+
+    # Every seed lies inside its own nucleus, so the labels are sequential
+    ground_truth = np.where(classes > 0, owner + 1, 0)
+    return class_image, ground_truth
+
+
+def synthetic_class_image(height, width, nuclei_per_megapixel=900, seed=0):
+    """ Returns a height x width x 3 uint8 class image with background, interior and boundary planes """
+    return synthetic_sample(height, width, nuclei_per_megapixel, seed)[0]
+
+
+def best_time(function, repeat, setup=None):
+    """ Runs 'function' 'repeat' times and returns the best wall time in seconds. 'setup()' runs untimed before
+    every repetition
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(function, setup=None):
+    """ Runs 'function' once and returns the peak memory it allocated, in bytes """
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(case, dataset, megapixels, function, repeat, setup=None):
+    """ Benchmarks one case and returns its result record """
+    seconds = best_time(function, repeat, setup)
+    peak = peak_memory(function, setup)
+    return {"case": case,
+            "dataset": dataset,
+            "megapixels": float(megapixels),
+            "seconds": seconds,
+            "megapixels_per_second": float(megapixels / seconds) if seconds > 0 else None,
+            "peak_mb": peak / 2 ** 20}
+
+
+def pixel_cases(user_options, size):
+    """ Yields the name and settings of every pixel method configuration measured on images of 'size' """
+    for borders in (0, 1):
+        for connectivity in (0, 1):
+            yield "pixel b={} c={}".format(borders, connectivity), dict(borders=borders, connectivity=connectivity,
+                                                                        seed=0)
+    for engine in user_options["engines"]:
+        if engine == "frontier" or (engine == "python" and size > user_options["python_max_size"]):
+            continue
+        yield "pixel engine={}".format(engine), dict(engine=engine)
+    for passes in user_options["passes"]:
+        yield "pixel passes={}".format(passes), dict(passes=passes)
+
+
+def synthetic_records(user_options, size, density):
+    class_image, ground_truth = synthetic_sample(size, size, density, seed=user_options["seed"])
+    dataset = "synthetic {0}x{0} {1}/MP".format(size, density)
+    megapixels = size * size / 1e6
+    repeat = user_options["repeat"]
+
+    yield measure("baseline", dataset, megapixels, lambda: pred.baseline_predictor(class_image), repeat)
+    for case, settings in pixel_cases(user_options, size):
+        yield measure(case, dataset, megapixels, lambda: pred.pixel_method(class_image, **settings), repeat)
+
+    prediction = pred.pixel_method(class_image)
+    prediction = skimage.segmentation.relabel_sequential(prediction)[0]
+    iou_array = eval.sparse_intersection_over_union(ground_truth, prediction)
+    if ground_truth.max() * prediction.max() <= DENSE_IOU_MAX_ENTRIES:
+        yield measure("intersection_over_union", dataset, megapixels,
+                      lambda: eval.intersection_over_union(ground_truth, prediction), repeat)
+    yield measure("sparse_intersection_over_union", dataset, megapixels,
+                  lambda: eval.sparse_intersection_over_union(ground_truth, prediction), repeat)
+    yield measure("measures_at", dataset, megapixels,
+                  lambda: [eval.measures_at(t, iou_array) for t in np.arange(0.5, 0.95, 0.05)], repeat)
+    yield measure("measures_at_thresholds", dataset, megapixels,
+                  lambda: eval.measures_at_thresholds(np.arange(0.5, 0.95, 0.05), iou_array), repeat)
+    yield measure("jaccard_index", dataset, megapixels, lambda: eval.jaccard_index(ground_truth, prediction), repeat)
+
+
+def dataset_records(user_options):
+    """ Benchmarks the full evaluation of every image of the real dataset, from the png files """
+    root_dir = user_options["root_dir"]
+    image_ids = sorted(shres.list_image_ids(root_dir))
+    class_files = [shres.Resources(root_dir, image_index=image_id).class_file for image_id in image_ids]
+    megapixels = sum(np.prod(artifact_cache.read_image(class_file).shape[:2]) for class_file in class_files) / 1e6
+    dataset = "{} ({} images)".format(os.path.basename(os.path.normpath(root_dir)), len(image_ids))
+
+    def evaluate_all(options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for image_id in image_ids:
+                eval.evaluate_jaccard_score(shres.Resources(root_dir, image_index=image_id, **options))
+
+    # Nothing may come from the caches, so every repetition decodes the png files again
+    for case, options in [("evaluate_jaccard_score baseline", {}),
+                          ("evaluate_jaccard_score pixel", {"predictor_name": "pixel", "seed": 0})]:
+        yield measure(case, dataset, megapixels, lambda: evaluate_all(options), user_options["repeat"],
+                      setup=artifact_cache.CACHE.clear)
+
+
+def startup_run(code):
+    """ Runs 'code' in a new Python process started in this directory. Returns the wall time in seconds, the peak
+    resident memory of the process in bytes and the slow dependencies it imported
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code + STARTUP_REPORT.format(SLOW_MODULES)],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    seconds = time.perf_counter() - start
+    peak, loaded = json.loads(output.splitlines()[-1])
+    return seconds, peak, loaded
+
+
+def measure_startup(case, megapixels, code, repeat):
+    """ Benchmarks the start-up case 'code' and returns its result record """
+    runs = [startup_run(code) for _ in range(repeat)]
+    seconds, peak, loaded = min(runs)
+    return {"case": case,
+            "dataset": "new process",
+            "megapixels": float(megapixels),
+            "seconds": seconds,
+            "megapixels_per_second": float(megapixels / seconds) if megapixels else None,
+            "peak_mb": peak / 2 ** 20,
+            "slow_modules": loaded}
+
+
+def startup_records(user_options):
+    """ Benchmarks importing each module, and predicting a 256 x 256 crop with the pixel method, in new processes """
+    repeat = user_options["repeat"]
+    for module in user_options["imports"]:
+        yield measure_startup("import {}".format(module), 0, "import {}".format(module), repeat)
+
+    class_image = synthetic_class_image(256, 256, seed=user_options["seed"])
+    with tempfile.TemporaryDirectory() as directory:
+        class_file = os.path.join(directory, "class_image.npy")
+        np.save(class_file, class_image)
+        yield measure_startup("pixel 256x256 from start-up", 256 * 256 / 1e6,
+                              "import numpy as np\nimport predictors as pred\n"
+                              "pred.pixel_method(np.load({!r}))".format(class_file), repeat)
+
+
+def run_suite(user_options):
+    # Stored predictions would hide the cost of the predictors
+    os.environ.pop(shres.STORE_ENV_VAR, None)
+
+    records = []
+    for density in user_options["densities"]:
+        for size in user_options["sizes"]:
+            for record in synthetic_records(user_options, size, density):
+                print("{:<40} {:<28} {:.4f} s".format(record["case"], record["dataset"], record["seconds"]))
+                records.append(record)
+    if user_options["root_dir"]:
+        for record in dataset_records(user_options):
+            print("{:<40} {:<28} {:.4f} s".format(record["case"], record["dataset"], record["seconds"]))
+            records.append(record)
+    if user_options.get("imports"):
+        for record in startup_records(user_options):
+            print("{:<40} {:<28} {:.4f} s  {}".format(record["case"], record["dataset"], record["seconds"],
+                                                      ", ".join(record["slow_modules"])))
+            records.append(record)
+    artifact_cache.CACHE.clear()
+
+    table = PrettyTable()
+    table.field_names = ["Case", "Dataset", "Time (s)", "MP/s", "Peak (MB)"]
+    for record in records:
+        table.add_row([record["case"], record["dataset"], round(record["seconds"], 4),
+                       round(record["megapixels_per_second"] or 0, 2), round(record["peak_mb"], 2)])
+    print(table)
+
+    results = {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.platform(),
+               "options": {key: value for key, value in user_options.items()
+                           if key not in ("json_file", "baseline_file", "tolerance")},
+               "results": records}
+    if user_options["json_file"] is not None:
+        with open(user_options["json_file"], "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+    """ Compares the cases of 'results' with the same cases of 'baseline' (both as saved by run_suite). Prints the
+    ratios and returns the list of regressions
+    """
+    baseline_records = {(record["case"], record["dataset"]): record for record in baseline["results"]}
+    table = PrettyTable()
+    table.field_names = ["Case", "Dataset", "Time (s)", "Baseline (s)", "Time ratio", "Peak ratio", "Status"]
+    regressions = []
+    for record in results["results"]:
+        old = baseline_records.get((record["case"], record["dataset"]))
+        if old is None:
+            continue
+        time_ratio = record["seconds"] / old["seconds"] if old["seconds"] > 0 else 1.0
+        # Small allocations and sub-millisecond differences are too noisy to compare
+        peak_ratio = record["peak_mb"] / old["peak_mb"] if old["peak_mb"] > 1 else 1.0
+        slower = time_ratio > 1 + tolerance and record["seconds"] - old["seconds"] > 1e-3
+        bigger = peak_ratio > 1 + tolerance
+        status = "ok"
+        if slower or bigger:
+            status = "REGRESSION ({})".format(", ".join(name for name, flag in [("time", slower), ("memory", bigger)]
+                                                         if flag))
+            regressions.append(record)
+        elif time_ratio < 1 - tolerance:
+            status = "faster"
+        table.add_row([record["case"], record["dataset"], round(record["seconds"], 4), round(old["seconds"], 4),
+                       round(time_ratio, 2), round(peak_ratio, 2), status])
+    print(table)
+    print("{} regressions".format(len(regressions)))
+    return regressions
+
+
+if __name__ == "__main__":
+    OPTIONS = parse_arguments()
+    RESULTS = run_suite(OPTIONS)
+    if OPTIONS["baseline_file"] is not None:
+        with open(OPTIONS["baseline_file"]) as BASELINE_FILE:
+            BASELINE = json.load(BASELINE_FILE)
+        if compare_results(RESULTS, BASELINE, OPTIONS["tolerance"]):
+            sys.exit(1)
@@ -0,0 +1,264 @@
+""" Index of the images of a dataset, so the scripts find them without checking every file.
+
+The index maps every image ID to the class image, annotation and raw image of that ID. It is built by listing the
+three directories of the dataset once and is saved in the dataset as a manifest (.manifest.json), which later runs
+reuse as long as the directories have not changed (three stat calls). The shape, size, modification time and
+SHA-256 checksum of the files of an image are only computed when they are asked for (details(), validate()), and are
+saved in the manifest too. IDs are the file names without the '_crop.png' suffix, so they can have any length.
+
+Packed datasets (see packed_dataset.py) are indexed by their own index file.
+
+Run this module as a script to build, list or verify the index of a dataset.
+"""
+
+import os
+import json
+import fnmatch
+import hashlib
+import argparse
+import struct
+import collections
+
+import packed_dataset
+
+MANIFEST_FILE_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+KINDS = list(packed_dataset.KINDS.keys())
+PNG_SUFFIX = packed_dataset.PNG_SUFFIX
+
+
+class DatasetIndex:
+    """ IDs and files of the images of a png dataset or a packed dataset """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.load()
+
+    def load(self):
+        """ Indexes the dataset, from its manifest when the directories have not changed """
+        root_dir = self.root_dir
+        self.packed = packed_dataset.is_packed(root_dir)
+        self.dirty = False
+        if self.packed:
+            self.dir_times = self.directory_times()
+            self.names = {kind: set() for kind in KINDS}
+            for image_id, kinds in packed_dataset.open_dataset(root_dir).index["images"].items():
+                for kind in kinds:
+                    self.names[kind].add(image_id)
+            self.details_of = {}
+            return
+
+        for kind in KINDS:
+            directory = self.directory(kind)
+            assert os.path.isdir(directory), "Unable to find {}".format(directory)
+        self.dir_times = self.directory_times()
+
+        manifest = self.read_manifest()
+        if manifest is not None and manifest["dir_times"] == self.dir_times:
+            self.names = {kind: set(ids) for kind, ids in manifest["names"].items()}
+            self.details_of = manifest["details"]
+            return
+
+        # The directories changed (or were never indexed): list them again, keeping the details of known images
+        self.names = {kind: set() for kind in KINDS}
+        for kind in KINDS:
+            with os.scandir(self.directory(kind)) as entries:
+                for entry in entries:
+                    if entry.name.endswith(PNG_SUFFIX):
+                        self.names[kind].add(entry.name[:-len(PNG_SUFFIX)])
+        self.details_of = {image_id: details for image_id, details in (manifest or {}).get("details", {}).items()
+                           if image_id in self.names["classes"]}
+        self.dirty = True
+        self.save()
+
+    def directory_times(self):
+        """ Modification times of the directories of the dataset (of the index file of a packed dataset), which
+        change when images are added or removed
+        """
+        if self.packed:
+            return {"index": os.stat(packed_dataset.index_path(self.root_dir)).st_mtime_ns}
+        return {kind: os.stat(self.directory(kind)).st_mtime_ns for kind in KINDS}
+
+    def refresh(self):
+        """ Indexes the dataset again when images were added or removed since it was indexed """
+        try:
+            changed = self.directory_times() != self.dir_times
+        except OSError:
+            return
+        if changed:
+            # Keep the details computed so far
+            self.save()
+            self.load()
+
+    def directory(self, kind):
+        return os.path.join(self.root_dir, packed_dataset.KINDS[kind][1])
+
+    def manifest_path(self):
+        return os.path.join(self.root_dir, MANIFEST_FILE_NAME)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path()) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def save(self):
+        """ Writes the manifest when it changed. Read-only datasets are indexed again by every process """
+        if self.packed or not self.dirty:
+            return
+        manifest = {"version": MANIFEST_VERSION,
+                    "dir_times": self.dir_times,
+                    "names": {kind: sorted(ids) for kind, ids in self.names.items()},
+                    "details": self.details_of}
+        temporary = "{}.{}.tmp".format(self.manifest_path(), os.getpid())
+        try:
+            with open(temporary, "w") as f:
+                json.dump(manifest, f)
+            os.replace(temporary, self.manifest_path())
+            self.dirty = False
+        except OSError:
+            pass
+
+    def image_ids(self, pattern=None, id_range=None):
+        """ Sorted IDs of the images that have a class image. 'pattern' is a glob on the ID (e.g. '1*'); 'id_range' is
+        an inclusive (first, last) pair, compared as numbers when the IDs are numbers
+        """
+        image_ids = sorted(self.names["classes"], key=id_sort_key)
+        if pattern is not None:
+            image_ids = fnmatch.filter(image_ids, pattern)
+        if id_range is not None:
+            first, last = id_sort_key(id_range[0]), id_sort_key(id_range[1])
+            image_ids = [image_id for image_id in image_ids if first <= id_sort_key(image_id) <= last]
+        return image_ids
+
+    def has_image(self, image_id, kind):
+        return str(image_id) in self.names[kind]
+
+    def file(self, image_id, kind):
+        """ Path of the image (a PackedImage for packed datasets), or None when the dataset does not have it """
+        image_id = str(image_id)
+        if not self.has_image(image_id, kind):
+            # The image may have been added since the dataset was indexed, e.g. while a service is running
+            self.refresh()
+            if not self.has_image(image_id, kind):
+                return None
+        if self.packed:
+            return packed_dataset.PackedImage(self.root_dir, kind, image_id)
+        return os.path.join(self.directory(kind), image_id + PNG_SUFFIX)
+
+    def details(self, image_id):
+        """ Shape, size, modification time and checksum of every file of the image. Computed on first use """
+        image_id = str(image_id)
+        if image_id not in self.details_of:
+            self.details_of[image_id] = {kind: file_details(self.file(image_id, kind)) for kind in KINDS
+                                         if self.has_image(image_id, kind)}
+            self.dirty = True
+        return self.details_of[image_id]
+
+    def validate(self, image_id):
+        """ Checks the files of the image against the index. Returns the kinds of the files that are missing or
+        changed; the details of changed files are updated
+        """
+        image_id = str(image_id)
+        known = self.details(image_id)
+        problems = []
+        for kind in KINDS:
+            path = self.file(image_id, kind)
+            if path is None or self.packed:
+                continue
+            if not os.path.isfile(path):
+                problems.append(kind)
+                continue
+            stat = os.stat(path)
+            if kind not in known or (stat.st_size, stat.st_mtime_ns) != (known[kind]["size"], known[kind]["mtime_ns"]):
+                known[kind] = file_details(path)
+                self.dirty = True
+                problems.append(kind)
+        return problems
+
+
+def id_sort_key(image_id):
+    """ Sorts numeric IDs by value, before any other ID """
+    image_id = str(image_id)
+    return (0, int(image_id), image_id) if image_id.isdigit() else (1, 0, image_id)
+
+
+def file_details(path):
+    if isinstance(path, packed_dataset.PackedImage):
+        data = path.load()
+        return {"shape": list(data.shape), "sha256": hashlib.sha256(data.tobytes()).hexdigest()}
+    with open(path, "rb") as f:
+        contents = f.read()
+    stat = os.stat(path)
+    return {"shape": png_shape(contents), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "sha256": hashlib.sha256(contents).hexdigest()}
+
+
+def png_shape(contents):
+    """ Shape of the image (height, width[, channels]) read from the header of a png file, without decoding it """
+    if contents[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    width, height, _, color_type = struct.unpack(">IIBB", contents[16:26])
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type, 1)
+    return [height, width] if channels == 1 else [height, width, channels]
+
+
+_opened = collections.OrderedDict()
+
+
+def open_index(root_dir):
+    """ Index of the dataset at 'root_dir', built once per process. Lookups of images missing from it check whether
+    the dataset changed (see DatasetIndex.refresh)
+    """
+    key = os.path.abspath(root_dir)
+    if key not in _opened:
+        _opened[key] = DatasetIndex(root_dir)
+    return _opened[key]
+
+
+def parse_arguments():
+    describe = "Builds, lists or verifies the index of the images of a dataset"
+    parser = argparse.ArgumentParser(description=describe)
+
+    help_r = "root directory containing classes, images, and annotations, or a packed dataset"
+    parser.add_argument("-r", "--root_dir", help=help_r, type=str, required=False, default="SmallEval")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("build", help="Indexes the dataset and computes the shape and checksum of every image")
+    listing = commands.add_parser("list", help="Lists the image IDs")
+    add_selection_arguments(listing)
+    commands.add_parser("verify", help="Checks every image against the index and reports missing or changed files")
+    return parser.parse_args()
+
+
+def add_selection_arguments(parser):
+    """ Adds the options that select images by ID to a script's parser """
+    help_g = "only process the images whose ID matches this glob pattern (e.g. '1*')"
+    parser.add_argument("-g", "--ids", help=help_g, type=str, required=False, default=None)
+
+    help_ra = "only process the images whose ID is between these two IDs (inclusive)"
+    parser.add_argument("-ra", "--id_range", help=help_ra, type=str, nargs=2, required=False, default=None)
+
+
+if __name__ == "__main__":
+    ARGS = parse_arguments()
+    INDEX = open_index(ARGS.root_dir)
+    if ARGS.command == "build":
+        for IMAGE_ID in INDEX.image_ids():
+            INDEX.validate(IMAGE_ID)
+        INDEX.save()
+        print("Indexed {} images of {}".format(len(INDEX.image_ids()), ARGS.root_dir))
+    elif ARGS.command == "list":
+        for IMAGE_ID in INDEX.image_ids(pattern=ARGS.ids, id_range=ARGS.id_range):
+            print(IMAGE_ID)
+    elif ARGS.command == "verify":
+        CHANGED = {IMAGE_ID: INDEX.validate(IMAGE_ID) for IMAGE_ID in INDEX.image_ids()}
+        for IMAGE_ID, KINDS_CHANGED in CHANGED.items():
+            if KINDS_CHANGED:
+                print("{}: missing or changed {}".format(IMAGE_ID, ", ".join(KINDS_CHANGED)))
+        INDEX.save()
+        print("{} of {} images changed".format(sum(1 for kinds in CHANGED.values() if kinds), len(CHANGED)))
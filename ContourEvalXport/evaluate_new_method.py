@@ -1,9 +1,27 @@
 import os
+import zlib
 import argparse
-import pandas as pd
+import tempfile
+import functools
+import artifact_cache
+import instrumentation
+import dataset_index
+import pipeline
+import results_file
 import shared_resources as shres
+import predictors as pred
 import show_eval as eval
 
+# Columns of the comparison table and the predictor options used to fill them. The predictor name of the new
+# method is given by the user
+COMPARE_COLUMNS = {
+    'baseline': {'predictor': 'baseline'},
+    'b=0 & c=0': {'borders': 0, 'connectivity': 0},
+    'b=1 & c=0': {'borders': 1, 'connectivity': 0},
+    'b=0 & c=1': {'borders': 0, 'connectivity': 1},
+    'b=1 & c=1': {'borders': 1, 'connectivity': 1}
+}
+
 
 def parse_arguments():
     describe = "finds predictor method to compare to the baseline and output file for table"
@@ -17,38 +35,146 @@ def parse_arguments():
 
     help_o = "output file for table"
     required.add_argument("-o", "--output_file", help=help_o, type=str, required=True)
+
+    help_w = "number of worker processes. Default is the number of CPUs"
+    parser.add_argument("-w", "--workers", help=help_w, type=int, required=False, default=os.cpu_count())
+
+    help_s = "seed of the random choices made when borders are joined. Each image gets its own seed derived from it"
+    parser.add_argument("-s", "--seed", help=help_s, type=int, required=False, default=0)
+
+    help_m = "largest number of passes of the pass sweep"
+    parser.add_argument("-m", "--max_passes", help=help_m, type=int, required=False, default=10)
+
+    help_f = "results file (JSON lines) where a row is appended for every evaluated image. An interrupted run " \
+             "resumes from the images missing in it"
+    parser.add_argument("-f", "--results_file", help=help_f, type=str, required=False, default=None)
+    pipeline.add_pipeline_arguments(parser)
+    dataset_index.add_selection_arguments(parser)
+    shres.add_store_argument(parser)
+    shres.add_trace_argument(parser)
     args = parser.parse_args()
+    shres.enable_prediction_store(args.store_dir)
+    shres.enable_tracing(args.trace_file)
     return {"root_dir": args.root_dir,
             "predictor": args.predictor,
-            "output_file": args.output_file}
+            "output_file": args.output_file,
+            "workers": args.workers,
+            "seed": args.seed,
+            "max_passes": args.max_passes,
+            "results_file": args.results_file,
+            "queue_size": args.queue_size,
+            "io_threads": args.io_threads,
+            "ids": args.ids,
+            "id_range": args.id_range}
+
+
+def image_seed(seed, image_id):
+    """ Seed for one image. It depends only on the image, so results do not depend on the order jobs finish in """
+    return zlib.crc32("{}:{}".format(seed, image_id).encode())
+
+
+def evaluate_job(job):
+    """ Computes the Jaccard scores of every predictor configuration of one image. The configurations share the
+    decoding and cleanup of the class image. Runs in the worker processes
+    """
+    root_dir, image_id, configurations = job
+    with instrumentation.image(image_id):
+        resources = shres.Resources(root_dir, image_index=image_id)
+        ground_truth = eval.load_ground_truth(resources.annot_file)
+        predictions = pred.Predictor(resources).predict_many(configurations)
+        return [eval.jaccard_index(ground_truth, predictions[settings]) for settings in configurations]
+
+
+def compare_job(job):
+    """ Result row of compare_to_baseline for one image """
+    _, image_id, _ = job
+    row = {'ID': image_id}
+    row.update(zip(COMPARE_COLUMNS.keys(), evaluate_job(job)))
+    return row
+
+
+def evaluate_passes_job(job):
+    """ Computes the Jaccard scores of the pixel method for passes = 0, 1, ..., max_passes on one image, from a single
+    run of the pixel method. Returns the result row of the image. Runs in the worker processes
+    """
+    root_dir, image_id, max_passes, seed = job
+    with instrumentation.image(image_id):
+        resources = shres.Resources(root_dir, image_index=image_id, predictor_name='pixel', seed=seed)
+        ground_truth = eval.load_ground_truth(resources.annot_file)
+        snapshots = pred.pixel_method_snapshots(resources.class_file, max_passes, borders=resources.borders,
+                                                connectivity=resources.connectivity, engine=resources.engine,
+                                                seed=resources.seed)
+        return {'ID': image_id, 'scores': [eval.jaccard_index(ground_truth, snapshot) for snapshot in snapshots]}
+
+
+def prefetch_job(job):
+    """ Reads the class and annotation files of a job ahead of its evaluation. Runs in the I/O threads """
+    root_dir, image_id = job[:2]
+    index = dataset_index.open_index(root_dir)
+    return job, pipeline.read_files([index.file(image_id, kind) for kind in ("classes", "annotations")])
+
+
+def run_prefetched(function, prefetched_job):
+    """ Runs 'function' on a job read by prefetch_job, decoding its files from memory. Runs in the worker processes """
+    job, contents = prefetched_job
+    with artifact_cache.prefetched(contents):
+        return function(job)
+
+
+def stream_results(user_options, run_options, make_job, function):
+    """ Evaluates every image that has no row in the results file yet and appends one row per image as soon as it is
+    computed. Reading the files, evaluating and writing the rows are pipelined, so they overlap on different images.
+    Returns the results file
+    """
+    results = results_file.ResultsFile(user_options["results_file"], run_options)
+    completed = results.completed()
+    image_ids = shres.list_image_ids(user_options["root_dir"], pattern=user_options.get("ids"),
+                                     id_range=user_options.get("id_range"))
+    jobs = (make_job(image_id) for image_id in image_ids if image_id not in completed)
+    stages = [pipeline.Stage("read", prefetch_job, "thread", user_options.get("io_threads", 4)),
+              pipeline.Stage("evaluate", functools.partial(run_prefetched, function), "process",
+                             user_options["workers"] or 1),
+              pipeline.Stage("write", results.append, "thread", 1)]
+    pipeline.run_pipeline(jobs, stages, queue_size=user_options.get("queue_size", 4))
+    return results
+
+
+def with_results_file(evaluation):
+    """ Runs 'evaluation' with a temporary results file when the user did not ask for one """
+    def run(user_options):
+        if user_options.get("results_file") is not None:
+            return evaluation(user_options)
+        handle, path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(handle)
+        os.remove(path)
+        try:
+            return evaluation(dict(user_options, results_file=path))
+        finally:
+            if os.path.isfile(path):
+                os.remove(path)
+    return run
+
+
+@with_results_file
+def compare_to_baseline(user_options):
+    run_options = {"evaluation": "compare_to_baseline", "root_dir": user_options["root_dir"],
+                   "predictor": user_options["predictor"], "seed": user_options["seed"],
+                   "ids": user_options.get("ids"), "id_range": user_options.get("id_range")}
 
+    # One job per image runs every configuration from a shared front end
+    def make_job(image_id):
+        configurations = []
+        for options in COMPARE_COLUMNS.values():
+            options = dict({'predictor': user_options["predictor"]}, **options)
+            configurations.append(shres.PredictorSettings(seed=image_seed(user_options["seed"], image_id), **options))
+        return user_options["root_dir"], image_id, configurations
 
-def compare_to_baseline(user_options):
-    jaccard_info = pd.DataFrame(columns=['ID', 'baseline', 'b=0 & c=0', 'b=1 & c=0', 'b=0 & c=1', 'b=1 & c=1'],
-                                copy=True)
-    class_dir_path = os.path.join(user_options["root_dir"], 'Classes')
-    for image in os.listdir(class_dir_path):
-        image_id = image[:3]
-        resources_baseline = shres.Resources('SmallEval', image_index=image_id)
-        resources_b0_c0 = shres.Resources('SmallEval', image_index=image_id, predictor_name=user_options["predictor"])
-        resources_b0_c1 = shres.Resources('SmallEval', image_index=image_id, predictor_name=user_options["predictor"],
-                                          connectivity=1)
-        resources_b1_c0 = shres.Resources('SmallEval', image_index=image_id, predictor_name=user_options["predictor"],
-                                          borders=1)
-        resources_b1_c1 = shres.Resources('SmallEval', image_index=image_id, predictor_name=user_options["predictor"],
-                                          borders=1,
-                                          connectivity=1)
-
-        jaccard_baseline = eval.evaluate_jaccard_score(resources_baseline)
-        jaccard_b0_c0 = eval.evaluate_jaccard_score(resources_b0_c0)
-        jaccard_b0_c1 = eval.evaluate_jaccard_score(resources_b0_c1)
-        jaccard_b1_c0 = eval.evaluate_jaccard_score(resources_b1_c0)
-        jaccard_b1_c1 = eval.evaluate_jaccard_score(resources_b1_c1)
-
-        jaccard_info = jaccard_info.append({'ID': image_id, 'baseline': jaccard_baseline,
-                                            'b=0 & c=0': jaccard_b0_c0, 'b=0 & c=1': jaccard_b0_c1,
-                                            'b=1 & c=0': jaccard_b1_c0, 'b=1 & c=1': jaccard_b1_c1},
-                                           ignore_index=True)
+    results = stream_results(user_options, run_options, make_job, compare_job)
+
+    # pandas is slow to import and only needed for the tables, so worker processes never load it
+    import pandas as pd
+    jaccard_info = pd.DataFrame(results.rows(), columns=['ID', 'baseline', 'b=0 & c=0', 'b=1 & c=0', 'b=0 & c=1',
+                                                         'b=1 & c=1'])
 
     info = 'Jaccard index table that compares the baseline method with the four types of new methods.' \
            '\nb=0 stands for' \
@@ -58,20 +184,23 @@ def compare_to_baseline(user_options):
     output_table(user_options, jaccard_info)
 
 
+@with_results_file
 def evaluate_passes(user_options):
-    jaccard_info = pd.DataFrame(columns=['107', '108', '109', '110', '209',
-                                         '296', '297', '307', '323', '324', '568', '578', '651', '713'],
-                                copy=True)
+    run_options = {"evaluation": "evaluate_passes", "root_dir": user_options["root_dir"],
+                   "seed": user_options["seed"], "max_passes": user_options["max_passes"],
+                   "ids": user_options.get("ids"), "id_range": user_options.get("id_range")}
+
+    # One job per image scores every pass count from a single run of the pixel method
+    def make_job(image_id):
+        return user_options["root_dir"], image_id, user_options["max_passes"], image_seed(user_options["seed"],
+                                                                                          image_id)
+
+    results = stream_results(user_options, run_options, make_job, evaluate_passes_job)
+
+    scores = {row["ID"]: row["scores"] for row in results.rows()}
+    import pandas as pd
+    jaccard_info = pd.DataFrame(scores, columns=sorted(scores, key=dataset_index.id_sort_key))
     jaccard_info.index.name = "# Passes"
-    class_dir_path = os.path.join(user_options["root_dir"], 'Classes')
-    for num_passes in range(0, 11):
-        scores = {}
-        for image in os.listdir(class_dir_path):
-            id = image[:3]
-            resources = shres.Resources('SmallEval', image_index=id, predictor_name='pixel', passes=num_passes)
-            jaccard_score = eval.evaluate_jaccard_score(resources)
-            scores[id] = jaccard_score
-        jaccard_info = jaccard_info.append(scores, ignore_index=True)
 
     max_values = jaccard_info.idxmax(axis=0)
     frequencies = max_values.value_counts(normalize=True)
@@ -0,0 +1,156 @@
+""" Opt-in instrumentation of the pipeline stages. Stages are timed with the 'stage' context manager or the 'timed'
+decorator, values such as pass counts and frontier sizes are recorded with 'count', and 'image' groups the stages of
+one image and records their per-image totals.
+
+Instrumentation is disabled unless a trace file is given, either with enable() or with the environment variable
+named by shared_resources.TRACE_ENV_VAR (the -tr option of the scripts sets both, so worker processes are
+instrumented too). When disabled, every call returns right after checking a module flag.
+
+The trace file format depends on its extension:
+    .jsonl: structured log with one JSON object per event
+    anything else: Chrome trace (JSON array format), to open in chrome://tracing or https://ui.perfetto.dev
+Every process appends its events to the same file, flushing them at the end of each image and at exit.
+"""
+
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import contextlib
+import multiprocessing.util
+
+import shared_resources as shres
+
+ENABLED = False
+TRACE_FILE = None
+
+# Flush the buffered events when they reach this number
+MAX_BUFFERED_EVENTS = 10000
+
+_NULL_STAGE = contextlib.nullcontext()
+_events = []
+_image_totals = []
+
+
+def enable(trace_file, truncate=True):
+    """ Starts recording events to 'trace_file' in this process. The file is emptied unless 'truncate' is False, as
+    in worker processes that add their events to the file of the main process
+    """
+    global ENABLED, TRACE_FILE
+    if ENABLED:
+        flush()
+    TRACE_FILE = trace_file
+    ENABLED = True
+    if truncate or not os.path.isfile(trace_file) or os.path.getsize(trace_file) == 0:
+        with open(trace_file, "w") as f:
+            if not trace_file.endswith(".jsonl"):
+                f.write("[\n")
+
+
+def disable():
+    global ENABLED
+    if ENABLED:
+        flush()
+    ENABLED = False
+
+
+def now_us():
+    return time.perf_counter_ns() // 1000
+
+
+def record(event):
+    """ Buffers one event in the Chrome trace event format """
+    event["pid"] = os.getpid()
+    event["tid"] = threading.get_ident()
+    _events.append(event)
+    if len(_events) >= MAX_BUFFERED_EVENTS:
+        flush()
+
+
+@contextlib.contextmanager
+def _stage(name, args):
+    start = now_us()
+    try:
+        yield
+    finally:
+        duration = now_us() - start
+        record({"name": name, "ph": "X", "ts": start, "dur": duration, "args": args})
+        if _image_totals:
+            totals = _image_totals[-1]
+            totals[name] = totals.get(name, 0) + duration
+
+
+def stage(name, **args):
+    """ Context manager that times the stage 'name'. 'args' are stored with the event """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _stage(name, args)
+
+
+def timed(name):
+    """ Decorator that times every call of the function as the stage 'name' """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _stage(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value):
+    """ Records the value of the counter 'name' (e.g. the size of a frontier) """
+    if ENABLED:
+        record({"name": name, "ph": "C", "ts": now_us(), "args": {name: int(value)}})
+
+
+@contextlib.contextmanager
+def _image(image_id):
+    _image_totals.append({})
+    start = now_us()
+    try:
+        yield
+    finally:
+        totals = _image_totals.pop()
+        record({"name": "image", "ph": "X", "ts": start, "dur": now_us() - start,
+                "args": dict({"image_id": str(image_id)}, **{"{} (ms)".format(name): duration / 1000
+                                                               for name, duration in totals.items()})})
+        flush()
+
+
+def image(image_id):
+    """ Context manager around the processing of one image. Records the total time of each stage in the image """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _image(image_id)
+
+
+def flush():
+    """ Appends the buffered events to the trace file """
+    if not _events or TRACE_FILE is None:
+        return
+    structured_log = TRACE_FILE.endswith(".jsonl")
+    lines = "".join(json.dumps(event) + ("\n" if structured_log else ",\n") for event in _events)
+    _events.clear()
+    # A Chrome trace may omit the closing bracket, so events of several processes can simply be appended
+    with open(TRACE_FILE, "a") as f:
+        f.write(lines)
+
+
+def _forget_parent_events():
+    # Events buffered by the parent belong to the parent; a forked worker must not write them again
+    _events.clear()
+    _image_totals.clear()
+
+
+if TRACE_FILE is None and os.environ.get(shres.TRACE_ENV_VAR):
+    enable(os.environ[shres.TRACE_ENV_VAR], truncate=False)
+
+os.register_at_fork(after_in_child=_forget_parent_events)
+atexit.register(flush)
+# Worker processes of multiprocessing do not run atexit handlers
+multiprocessing.util.Finalize(None, flush, exitpriority=0)
@@ -0,0 +1,143 @@
+""" Packed, memory-mappable container for a dataset, so the images are decoded once instead of on every run.
+
+A packed dataset is a directory with one raw file per kind of image (classes.bin, annotations.bin, images.bin) and
+an index (index.json) with the offset, shape and dtype of every image in those files. Images are read as views of a
+np.memmap of the file, so reading one costs no decoding and no copy, and worker processes share the pages of the
+operating system's file cache instead of holding their own decoded copy.
+
+A packed directory can be used as the root directory of every script: shared_resources.Resources then refers to
+the images with PackedImage references instead of paths, which artifact_cache.read_image understands.
+
+Run this module as a script to pack a dataset.
+"""
+
+import os
+import json
+import argparse
+import collections
+import numpy as np
+
+INDEX_FILE_NAME = "index.json"
+FORMAT_VERSION = 1
+# Every image starts at a multiple of this number of bytes, so its view can have any dtype
+ALIGNMENT = 64
+# Kind of image, its file in the packed directory and its directory in a png dataset
+KINDS = collections.OrderedDict([("classes", ("classes.bin", "Classes")),
+                                 ("annotations", ("annotations.bin", "Annotations")),
+                                 ("images", ("images.bin", "Images"))])
+PNG_SUFFIX = "_crop.png"
+
+
+class PackedImage(collections.namedtuple("PackedImage", ["dataset_dir", "kind", "image_id"])):
+    """ Reference to one image of a packed dataset. It is small and picklable, so it can be sent to worker
+    processes, which map the file themselves
+    """
+
+    def load(self):
+        """ Read-only view of the image in the memory-mapped file """
+        return open_dataset(self.dataset_dir).image(self.kind, self.image_id)
+
+    def key(self):
+        """ Identifies the contents of the image; changes when the dataset is packed again """
+        return os.path.abspath(self.dataset_dir), os.stat(index_path(self.dataset_dir)).st_mtime_ns, self.kind, \
+            self.image_id
+
+
+class PackedDataset:
+    """ Opened packed dataset. The data files are mapped once per process and shared by all the images """
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        with open(index_path(dataset_dir)) as f:
+            self.index = json.load(f)
+        if self.index.get("version") != FORMAT_VERSION:
+            raise ValueError("Unsupported packed dataset version in {}".format(dataset_dir))
+        self.maps = {}
+
+    def image_ids(self):
+        return list(self.index["images"].keys())
+
+    def has_image(self, kind, image_id):
+        return kind in self.index["images"].get(str(image_id), {})
+
+    def image(self, kind, image_id):
+        entry = self.index["images"][str(image_id)][kind]
+        if kind not in self.maps:
+            self.maps[kind] = np.memmap(os.path.join(self.dataset_dir, KINDS[kind][0]), dtype=np.uint8, mode='r')
+        dtype = np.dtype(entry["dtype"])
+        size = int(np.prod(entry["shape"])) * dtype.itemsize
+        return self.maps[kind][entry["offset"]:entry["offset"] + size].view(dtype).reshape(entry["shape"])
+
+
+_opened = {}
+
+
+def open_dataset(dataset_dir):
+    """ Opens a packed dataset once per process (and again when it is packed again) """
+    key = os.path.abspath(dataset_dir), os.stat(index_path(dataset_dir)).st_mtime_ns
+    if key not in _opened:
+        _opened[key] = PackedDataset(dataset_dir)
+    return _opened[key]
+
+
+def index_path(dataset_dir):
+    return os.path.join(dataset_dir, INDEX_FILE_NAME)
+
+
+def is_packed(root_dir):
+    """ Whether 'root_dir' is a packed dataset """
+    return os.path.isfile(index_path(root_dir))
+
+
+def pack_dataset(root_dir, output_dir):
+    """ Decodes every png of the dataset at 'root_dir' and writes them to a packed dataset at 'output_dir'. Images
+    are written one at a time, so the dataset does not need to fit in memory. Returns the index
+    """
+    import skimage.io
+    os.makedirs(output_dir, exist_ok=True)
+    images = collections.OrderedDict()
+    for kind, (file_name, dir_name) in KINDS.items():
+        png_dir = os.path.join(root_dir, dir_name)
+        if not os.path.isdir(png_dir):
+            continue
+        offset = 0
+        with open(os.path.join(output_dir, file_name), "wb") as f:
+            for name in sorted(os.listdir(png_dir)):
+                if not name.endswith(PNG_SUFFIX):
+                    continue
+                data = np.ascontiguousarray(skimage.io.imread(os.path.join(png_dir, name)))
+                images.setdefault(name[:-len(PNG_SUFFIX)], {})[kind] = {"offset": offset,
+                                                                       "shape": list(data.shape),
+                                                                       "dtype": data.dtype.str}
+                f.write(data.tobytes())
+                padding = -data.nbytes % ALIGNMENT
+                f.write(b"\0" * padding)
+                offset += data.nbytes + padding
+
+    index = {"version": FORMAT_VERSION, "source": os.path.abspath(root_dir), "images": images}
+    # The index is written last, so a partially packed directory is never taken for a packed dataset
+    temporary = index_path(output_dir) + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(index, f)
+    os.replace(temporary, index_path(output_dir))
+    return index
+
+
+def parse_arguments():
+    describe = "Packs the png images of a dataset into a memory-mappable container"
+    parser = argparse.ArgumentParser(description=describe)
+
+    help_r = "root directory containing classes, images, and annotations"
+    parser.add_argument("-r", "--root_dir", help=help_r, type=str, required=False, default="SmallEval")
+
+    help_o = "output directory of the packed dataset. Default is the root directory followed by .packed"
+    parser.add_argument("-o", "--output_dir", help=help_o, type=str, required=False, default=None)
+    args = parser.parse_args()
+    return {"root_dir": args.root_dir,
+            "output_dir": args.output_dir or os.path.normpath(args.root_dir) + ".packed"}
+
+
+if __name__ == "__main__":
+    OPTIONS = parse_arguments()
+    INDEX = pack_dataset(OPTIONS["root_dir"], OPTIONS["output_dir"])
+    print("Packed {} images into {}".format(len(INDEX["images"]), OPTIONS["output_dir"]))
@@ -0,0 +1,126 @@
+""" Pipelined executor for the batch drivers. Every item (the job of one image) goes through a list of stages, e.g.
+reading its files, computing its results and writing them. The stages run concurrently on different images, so
+reading from a slow (network) disk overlaps with the computations, and the throughput approaches the speed of the
+slowest stage instead of the sum of the stages.
+
+The stages are connected by bounded queues (queue_size items each), so a fast stage cannot run far ahead of a slow
+one and memory does not grow with the dataset. I/O stages run in threads, CPU stages in worker processes; the stages
+are coordinated by an asyncio event loop. Every stage passes on its outputs in the order of the items.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+
+import instrumentation
+
+# 'function' is called on each item. 'executor' is "thread" for I/O stages and "process" for CPU stages, whose
+# function must be picklable; 'workers' is the number of items the stage processes at a time. A process stage with
+# one worker runs in a thread of this process, like the serial runs of the scripts
+Stage = collections.namedtuple("Stage", ["name", "function", "executor", "workers"])
+
+# Marks the end of the items in a queue
+_END = object()
+
+
+def run_pipeline(items, stages, queue_size=4):
+    """ Runs every item of the iterable 'items' through 'stages'. Items are taken lazily. Returns the outputs of the
+    last stage in the order of 'items'. The first error of a stage stops the pipeline and is raised
+    """
+    return asyncio.run(_run_pipeline(items, stages, queue_size))
+
+
+async def _run_pipeline(items, stages, queue_size):
+    executors = [make_executor(stage) for stage in stages]
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    outputs = []
+    tasks = [asyncio.create_task(_feed(items, queues[0]))]
+    for stage, executor, inputs, results in zip(stages, executors, queues, queues[1:]):
+        tasks.append(asyncio.create_task(_run_stage(stage, executor, inputs, results, queue_size)))
+    tasks.append(asyncio.create_task(_collect(queues[-1], outputs)))
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+    return outputs
+
+
+def make_executor(stage):
+    if stage.executor == "process" and stage.workers > 1:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=stage.workers)
+    if stage.executor not in ("thread", "process"):
+        raise ValueError(stage.executor)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max(stage.workers, 1))
+
+
+async def _feed(items, queue):
+    # The items are taken one at a time, as the first queue has room for them
+    for index, item in enumerate(items):
+        await queue.put((index, item))
+    await queue.put(_END)
+
+
+async def _run_stage(stage, executor, inputs, results, queue_size):
+    """ Takes the items of 'inputs', runs the function of the stage on up to 'workers' of them at a time and puts the
+    outputs on 'results' in the order of the items
+    """
+    loop = asyncio.get_running_loop()
+    finished = {}
+    next_index = 0
+    # Outputs wait in 'finished' until the outputs of the earlier items are passed on; this bounds their number
+    slots = asyncio.Semaphore(max(stage.workers, 1) + queue_size)
+
+    async def work():
+        nonlocal next_index
+        while True:
+            await slots.acquire()
+            entry = await inputs.get()
+            if entry is _END:
+                await inputs.put(_END)
+                slots.release()
+                return
+            index, item = entry
+            instrumentation.count("queue " + stage.name, inputs.qsize())
+            finished[index] = await loop.run_in_executor(executor, stage.function, item)
+            while next_index in finished:
+                await results.put((next_index, finished.pop(next_index)))
+                next_index += 1
+                slots.release()
+
+    await asyncio.gather(*[work() for _ in range(max(stage.workers, 1))])
+    await results.put(_END)
+
+
+async def _collect(queue, outputs):
+    while True:
+        entry = await queue.get()
+        if entry is _END:
+            return
+        outputs.append(entry[1])
+
+
+def read_files(paths):
+    """ Contents of the files at 'paths', keyed by path. Other references (e.g. images of packed datasets, which are
+    memory-mapped) are skipped
+    """
+    contents = {}
+    for path in paths:
+        if isinstance(path, str):
+            with open(path, "rb") as f:
+                contents[path] = f.read()
+    return contents
+
+
+def add_pipeline_arguments(parser):
+    """ Adds the options of the pipeline to a script's parser """
+    help_q = "number of images waiting between two stages of the pipeline (read, compute, write). Bounds the memory " \
+             "used by images read ahead"
+    parser.add_argument("-q", "--queue_size", help=help_q, type=int, required=False, default=4)
+
+    help_io = "number of threads reading the files of the images ahead of their processing"
+    parser.add_argument("-io", "--io_threads", help=help_io, type=int, required=False, default=4)
@@ -0,0 +1,172 @@
+""" Persistent on-disk store of predictor outputs, so predictions survive between runs of the scripts.
+
+Each prediction is a compressed .npz file at <store>/v<STORE_VERSION>/<hash of the class file contents>/<predictor
+settings>.npz. Predictions of older versions are never read, and are removed by the evict command.
+Predictor.predict checks the store before computing a prediction for a class file and fills it in afterwards. The
+store is enabled by setting the environment variable named by shared_resources.STORE_ENV_VAR to its directory (the
+-st option of the scripts does this), which also enables it in worker processes.
+
+Run this module as a script to inspect the store, warm it for a dataset, or evict entries from it.
+"""
+
+import os
+import time
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+
+import artifact_cache
+import packed_dataset
+import shared_resources as shres
+
+DEFAULT_STORE_DIR = ".prediction_store"
+# Version of the predictor outputs. Bump it whenever a predictor gives a different output for the same settings
+# (e.g. a change of its cleanup), so the store does not serve predictions of the older code
+STORE_VERSION = 2
+
+
+class PredictionStore:
+    """ Directory of stored predictions keyed by class file contents and predictor settings """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def path(self, class_file, settings):
+        """ Location of the prediction of 'class_file' with 'settings' """
+        name = "_".join("{}={}".format(field, value) for field, value in settings._asdict().items())
+        return os.path.join(self.store_dir, "v{}".format(STORE_VERSION), content_hash(class_file), name + ".npz")
+
+    def load(self, class_file, settings):
+        """ Returns the stored prediction, or None when it is not in the store """
+        path = self.path(class_file, settings)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as stored:
+            return stored["labels"]
+
+    def save(self, class_file, settings, labels):
+        path = self.path(class_file, settings)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so concurrent workers never read a partial file
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz")
+        with os.fdopen(handle, "wb") as f:
+            np.savez_compressed(f, labels=labels)
+        os.replace(temporary, path)
+
+    def get(self, class_file, settings, compute):
+        """ Returns the stored prediction, computing and storing it with 'compute()' when it is missing """
+        labels = self.load(class_file, settings)
+        if labels is None:
+            labels = compute()
+            self.save(class_file, settings, labels)
+        return labels
+
+    def entries(self):
+        """ Yields the path, size and last modification time of every stored prediction """
+        for root, _, files in os.walk(self.store_dir):
+            for name in files:
+                if name.endswith(".npz"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield path, stat.st_size, stat.st_mtime
+
+    def evict(self, max_age=None, max_bytes=None):
+        """ Removes entries of older versions and entries older than 'max_age' seconds, then the oldest entries until
+        the store is below 'max_bytes'. Removes everything when both are None. Returns the number of removed entries.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        current = os.path.join(self.store_dir, "v{}".format(STORE_VERSION), "")
+        now = time.time()
+        removed = 0
+        for path, size, modified in entries:
+            too_old = not path.startswith(current) or (max_age is not None and now - modified > max_age)
+            too_big = max_bytes is not None and total > max_bytes
+            if too_old or too_big or (max_age is None and max_bytes is None):
+                os.remove(path)
+                total -= size
+                removed += 1
+        for root, dirs, files in os.walk(self.store_dir, topdown=False):
+            if root != self.store_dir and not dirs and not files:
+                os.rmdir(root)
+        return removed
+
+
+def content_hash(path):
+    """ SHA-256 of the contents of the file at 'path' (or of the pixels of an image of a packed dataset). Cached per
+    process
+    """
+    def compute():
+        if isinstance(path, packed_dataset.PackedImage):
+            return hashlib.sha256(path.load().tobytes()).hexdigest()
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    return artifact_cache.CACHE.get(artifact_cache.file_key("sha256", path), compute)
+
+
+def default_store():
+    """ Store selected with the environment variable, or None when the store is disabled """
+    store_dir = os.environ.get(shres.STORE_ENV_VAR)
+    if not store_dir:
+        return None
+    return PredictionStore(store_dir)
+
+
+def parse_arguments():
+    describe = "Inspects, warms or evicts the persistent prediction store"
+    parser = argparse.ArgumentParser(description=describe)
+
+    help_s = "Store directory. Default is ${} or {}".format(shres.STORE_ENV_VAR, DEFAULT_STORE_DIR)
+    parser.add_argument("-st", "--store_dir", help=help_s, type=str, required=False,
+                        default=os.environ.get(shres.STORE_ENV_VAR) or DEFAULT_STORE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("info", help="Shows the number and size of the stored predictions")
+
+    warm = commands.add_parser("warm", help="Computes and stores the predictions of every image of a dataset")
+    warm.add_argument("-r", "--root_dir", help="root directory containing images, classes, and annotations",
+                      type=str, required=False, default="SmallEval")
+    warm.add_argument("-p", "--predictor", help="Predictor name", type=str, default=shres.DEFAULT_PREDICTOR)
+    warm.add_argument("-b", "--borders", help="0 to separate borders, 1 to join", type=int, default=0)
+    warm.add_argument("-c", "--connectivity", help="0 is vertices, 1 is edges", type=int, default=0)
+    warm.add_argument("-pa", "--passes", help="Counts how many passes the pixel_method does.", type=int, default=None)
+    warm.add_argument("-s", "--seed", help="Seed of the random choices when borders are joined", type=int,
+                      default=None)
+
+    evict = commands.add_parser("evict", help="Removes stored predictions (all of them by default)")
+    evict.add_argument("-d", "--max_days", help="Remove entries older than this number of days", type=float,
+                       default=None)
+    evict.add_argument("-m", "--max_mb", help="Remove the oldest entries until the store is below this size",
+                       type=float, default=None)
+    return parser.parse_args()
+
+
+def warm_store(store, args):
+    # predictors uses this module, so it is only imported when the store is warmed from the command line
+    import predictors as pred
+
+    settings = shres.PredictorSettings(predictor=args.predictor, borders=args.borders, connectivity=args.connectivity,
+                                       passes=args.passes, seed=args.seed)
+    predictor = pred.Predictor(settings)
+    for image_id in sorted(shres.list_image_ids(args.root_dir)):
+        class_file = shres.Resources(args.root_dir, image_index=image_id).class_file
+        store.get(class_file, settings, lambda: predictor.run(class_file))
+        print("Stored {}".format(class_file))
+
+
+if __name__ == "__main__":
+    ARGS = parse_arguments()
+    STORE = PredictionStore(ARGS.store_dir)
+    if ARGS.command == "info":
+        ENTRIES = list(STORE.entries())
+        print("Store: {}".format(os.path.abspath(ARGS.store_dir)))
+        print("Predictions: {}".format(len(ENTRIES)))
+        print("Class files: {}".format(len({os.path.dirname(path) for path, _, _ in ENTRIES})))
+        print("Size: {:.2f} MB".format(sum(size for _, size, _ in ENTRIES) / 2 ** 20))
+    elif ARGS.command == "warm":
+        warm_store(STORE, ARGS)
+    elif ARGS.command == "evict":
+        MAX_AGE = None if ARGS.max_days is None else ARGS.max_days * 24 * 3600
+        MAX_BYTES = None if ARGS.max_mb is None else ARGS.max_mb * 2 ** 20
+        print("Removed {} predictions".format(STORE.evict(max_age=MAX_AGE, max_bytes=MAX_BYTES)))
@@ -0,0 +1,387 @@
+""" Long-running local predictor service, so other programs (e.g. the U-Net stage that produces the class maps) can
+run boundary correction per image or tile without paying the start-up of a script on every call.
+
+The service is a stdlib HTTP server. Requests are collected by a batcher thread for a few milliseconds (-bw) and
+sent as one batch to a pool of worker processes that have imported the predictors and run every predictor once on a
+small image, so the first request does not pay the imports or the compilation of the numba engine. Requests of one
+batch that refer to the same class image share its front end (see predictors.Predictor.predict_many).
+
+Endpoints:
+    POST /predict   class image and predictor settings, answers the label image as a .npy file
+                    - body of type application/x-npy: the class map array (height x width x 3) saved with np.save,
+                      with the settings in the query string (e.g. /predict?predictor=pixel&borders=1)
+                    - body of type application/json: {"class_file": path} or {"root_dir": dataset, "id": image ID},
+                      with the settings as more keys or in the query string
+    GET /stats      JSON with the number of requests, errors and batches, and the p50/p99 latency in milliseconds
+    GET /health     answers 200 once the workers are warm
+
+request_prediction() is a client for Python callers.
+"""
+
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import http.server
+import urllib.parse
+import urllib.request
+import concurrent.futures
+import numpy as np
+
+import dataset_index
+import instrumentation
+import shared_resources as shres
+import predictors as pred
+
+# Number of latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+# Seconds a request waits for its prediction before it fails
+DEFAULT_REQUEST_TIMEOUT = 600.0
+# Types of the settings given in a query string or a JSON body; passes and seed can also be empty (None)
+SETTING_TYPES = {"predictor": str, "borders": int, "connectivity": int, "passes": int, "engine": str, "seed": int,
+                 "cell_min_size": int}
+
+
+class ServiceRequest:
+    """ One prediction waiting for its batch. The handler thread waits on 'done' """
+
+    def __init__(self, class_image, settings):
+        self.class_image = class_image
+        self.settings = settings
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.labels = None
+        self.error = None
+
+    def finish(self, labels=None, error=None):
+        self.labels = labels
+        self.error = error
+        self.done.set()
+
+
+class PredictorService:
+    """ Batches the requests and runs them on warm worker processes (in the batcher thread when 'workers' is 0) """
+
+    def __init__(self, workers=os.cpu_count(), batch_window=0.005, max_batch=32, warm_engines=("frontier",),
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT):
+        self.workers = workers
+        self.warm_engines = warm_engines
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.request_timeout = request_timeout
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.executor = None
+        if workers:
+            self.start_workers()
+        else:
+            warm_worker(warm_engines)
+        self.batcher = threading.Thread(target=self.run_batches, daemon=True)
+        self.batcher.start()
+
+    def start_workers(self):
+        """ Starts a new pool of warm worker processes """
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker,
+                                                               initargs=(self.warm_engines,))
+        # Start every worker now, so they are warm before the first request
+        list(self.executor.map(worker_pid, range(self.workers)))
+
+    def restart_workers(self):
+        """ Replaces a pool that can no longer run jobs, e.g. because a worker process was killed """
+        with self.lock:
+            self.counts["worker restarts"] += 1
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.start_workers()
+
+    def predict(self, class_image, settings):
+        """ Label image of 'class_image' (a path, a packed_dataset.PackedImage or an array). Blocks until its batch
+        is done; raises the error of the predictor, or TimeoutError after the request timeout
+        """
+        request = ServiceRequest(class_image, settings)
+        self.requests.put(request)
+        if not request.done.wait(self.request_timeout):
+            request.finish(error=TimeoutError("no prediction after {} s".format(self.request_timeout)))
+        with self.lock:
+            self.latencies.append(time.perf_counter() - request.arrival)
+            self.counts["errors" if request.error is not None else "requests"] += 1
+        if request.error is not None:
+            raise request.error
+        return request.labels
+
+    def next_batch(self):
+        """ Waits for a request, then collects the requests that arrive within the batch window """
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batches(self):
+        while True:
+            batch = self.next_batch()
+            with self.lock:
+                self.counts["batches"] += 1
+                self.counts["batched requests"] += len(batch)
+            jobs = [(request.class_image, request.settings) for request in batch]
+            if self.executor is None:
+                self.finish_batch(batch, run_batch(jobs))
+                continue
+            # Split the batch so every worker gets a part of it
+            size = -(-len(batch) // self.workers)
+            for start in range(0, len(batch), size):
+                part = batch[start:start + size]
+                try:
+                    future = self.submit(jobs[start:start + size])
+                except concurrent.futures.BrokenExecutor as error:
+                    self.finish_batch(part, [(None, error)] * len(part))
+                    continue
+                future.add_done_callback(lambda done, part=part: self.finish_batch(part, done))
+
+    def submit(self, jobs):
+        """ Sends jobs to the workers. When a worker died (e.g. out of memory), the jobs that were running on it have
+        failed with it; these jobs never ran, so they go to a new pool
+        """
+        try:
+            return self.executor.submit(run_batch, jobs)
+        except concurrent.futures.BrokenExecutor:
+            self.restart_workers()
+            return self.executor.submit(run_batch, jobs)
+
+    @staticmethod
+    def finish_batch(batch, outputs):
+        if isinstance(outputs, concurrent.futures.Future):
+            try:
+                outputs = outputs.result()
+            except Exception as error:
+                outputs = [(None, error)] * len(batch)
+        for request, (labels, error) in zip(batch, outputs):
+            if not request.done.is_set():
+                request.finish(labels, error)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            counts = dict(self.counts)
+        batches = counts.pop("batches", 0)
+        batched = counts.pop("batched requests", 0)
+        return {"requests": counts.get("requests", 0),
+                "errors": counts.get("errors", 0),
+                "worker restarts": counts.get("worker restarts", 0),
+                "batches": batches,
+                "mean batch size": batched / batches if batches else 0,
+                "p50 (ms)": float(np.percentile(latencies, 50)) if latencies.size else None,
+                "p99 (ms)": float(np.percentile(latencies, 99)) if latencies.size else None}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def warm_worker(engines):
+    """ Imports and runs every predictor (and each engine of the pixel method) once on a small synthetic image """
+    class_image = np.zeros((32, 32, 3), dtype=np.uint8)
+    class_image[:, :, 0] = 255
+    class_image[8:24, 8:24] = (0, 0, 255)
+    class_image[10:22, 10:22] = (0, 255, 0)
+    for predictor in pred.Predictor(None).options.keys():
+        pred.Predictor(shres.PredictorSettings(predictor=predictor)).predict(class_image)
+    for engine in engines:
+        pred.Predictor(shres.PredictorSettings(predictor="pixel", engine=engine)).predict(class_image)
+
+
+def worker_pid(_):
+    return os.getpid()
+
+
+def run_batch(jobs):
+    """ Runs the (class image, settings) jobs of a batch. Jobs with the same class file share its front end. Returns
+    a (labels, error) pair per job. Runs in the worker processes
+    """
+    outputs = {}
+    by_image = collections.OrderedDict()
+    for position, (class_image, settings) in enumerate(jobs):
+        key = class_image if isinstance(class_image, (str, tuple)) else ("array", position)
+        by_image.setdefault(key, []).append(position)
+    with instrumentation.stage("service batch", size=len(jobs)):
+        for positions in by_image.values():
+            class_image = jobs[positions[0]][0]
+            configurations = [jobs[position][1] for position in positions]
+            try:
+                predictions = pred.Predictor(configurations[0]).predict_many(configurations, class_image)
+                for position in positions:
+                    outputs[position] = (predictions[jobs[position][1]], None)
+            except Exception as error:
+                for position in positions:
+                    outputs[position] = (None, error)
+    instrumentation.flush()
+    return [outputs[position] for position in range(len(jobs))]
+
+
+def parse_settings(values):
+    """ PredictorSettings from a dictionary of strings (a query string) or JSON values. Raises ValueError """
+    settings = {}
+    for field, value in values.items():
+        if field not in SETTING_TYPES:
+            continue
+        settings[field] = None if value in (None, "") else SETTING_TYPES[field](value)
+    settings = shres.PredictorSettings(**settings)
+    if settings.predictor not in pred.Predictor(settings).options.keys():
+        raise ValueError(settings.predictor)
+    return settings
+
+
+def class_image_of(body):
+    """ Class image referred to by a JSON request: a path, or the ID of an image of a dataset """
+    if "class_file" in body:
+        return body["class_file"]
+    class_file = dataset_index.open_index(body["root_dir"]).file(body["id"], "classes")
+    if class_file is None:
+        raise ValueError("Unable to find class image {} in {}".format(body["id"], body["root_dir"]))
+    return class_file
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers the requests of the HTTP server with the PredictorService of the server """
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/stats":
+            self.answer(200, json.dumps(self.server.service.stats()).encode(), "application/json")
+        elif path == "/health":
+            self.answer(200, b"ok", "text/plain")
+        else:
+            self.answer(404, b"unknown endpoint", "text/plain")
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/predict":
+            self.answer(404, b"unknown endpoint", "text/plain")
+            return
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type", "") == "application/json":
+                body = json.loads(body)
+                class_image = class_image_of(body)
+                settings = parse_settings(dict(query, **body))
+            else:
+                class_image = np.load(io.BytesIO(body), allow_pickle=False)
+                settings = parse_settings(query)
+        except (ValueError, KeyError, TypeError) as error:
+            self.answer(400, "bad request: {!r}".format(error).encode(), "text/plain")
+            return
+
+        try:
+            labels = self.server.service.predict(class_image, settings)
+        except TimeoutError as error:
+            self.answer(504, "prediction timed out: {!r}".format(error).encode(), "text/plain")
+            return
+        except Exception as error:
+            self.answer(500, "prediction failed: {!r}".format(error).encode(), "text/plain")
+            return
+        output = io.BytesIO()
+        np.save(output, labels, allow_pickle=False)
+        self.answer(200, output.getvalue(), "application/x-npy")
+
+    def answer(self, status, contents, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    def log_message(self, format, *args):
+        # Latencies are reported by /stats instead of a log line per request
+        pass
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    """ Answers HTTP requests with 'service' until interrupted """
+    server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+def request_prediction(url, class_image, **settings):
+    """ Client of the service at 'url' (e.g. http://127.0.0.1:8765). 'class_image' is a class map array or the path
+    of a class image readable by the service. Returns the label image
+    """
+    query = urllib.parse.urlencode({field: "" if value is None else value for field, value in settings.items()})
+    if isinstance(class_image, np.ndarray):
+        body = io.BytesIO()
+        np.save(body, class_image, allow_pickle=False)
+        request = urllib.request.Request("{}/predict?{}".format(url, query), data=body.getvalue(),
+                                         headers={"Content-Type": "application/x-npy"})
+    else:
+        request = urllib.request.Request("{}/predict?{}".format(url, query),
+                                         data=json.dumps({"class_file": class_image}).encode(),
+                                         headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return np.load(io.BytesIO(response.read()), allow_pickle=False)
+
+
+def parse_arguments():
+    describe = "Serves the predictors over HTTP to local programs, with warm worker processes"
+    parser = argparse.ArgumentParser(description=describe)
+
+    help_ho = "address to listen on. Default is 127.0.0.1 (local programs only)"
+    parser.add_argument("-ho", "--host", help=help_ho, type=str, required=False, default="127.0.0.1")
+
+    help_po = "port to listen on"
+    parser.add_argument("-po", "--port", help=help_po, type=int, required=False, default=8765)
+
+    help_w = "number of worker processes. Default is the number of CPUs; 0 runs the predictors in the server process"
+    parser.add_argument("-w", "--workers", help=help_w, type=int, required=False, default=os.cpu_count())
+
+    help_bw = "milliseconds the batcher waits for more requests before sending a batch to the workers"
+    parser.add_argument("-bw", "--batch_window", help=help_bw, type=float, required=False, default=5.0)
+
+    help_mb = "largest number of requests in a batch"
+    parser.add_argument("-mb", "--max_batch", help=help_mb, type=int, required=False, default=32)
+
+    help_e = "engines of the pixel method the workers warm up (e.g. numba, which compiles on first use)"
+    parser.add_argument("-e", "--engines", help=help_e, type=str, nargs="+", required=False, default=["frontier"])
+
+    help_rt = "seconds a request waits for its prediction before it fails"
+    parser.add_argument("-rt", "--request_timeout", help=help_rt, type=float, required=False,
+                        default=DEFAULT_REQUEST_TIMEOUT)
+
+    shres.add_store_argument(parser)
+    shres.add_trace_argument(parser)
+    args = parser.parse_args()
+    shres.enable_prediction_store(args.store_dir)
+    shres.enable_tracing(args.trace_file)
+
+    return {"host": args.host,
+            "port": args.port,
+            "workers": args.workers,
+            "batch_window": args.batch_window / 1000,
+            "max_batch": args.max_batch,
+            "engines": args.engines,
+            "request_timeout": args.request_timeout}
+
+
+if __name__ == "__main__":
+    OPTIONS = parse_arguments()
+    SERVICE = PredictorService(workers=OPTIONS["workers"], batch_window=OPTIONS["batch_window"],
+                               max_batch=OPTIONS["max_batch"], warm_engines=OPTIONS["engines"],
+                               request_timeout=OPTIONS["request_timeout"])
+    print("Serving the predictors on http://{}:{}".format(OPTIONS["host"], OPTIONS["port"]))
+    serve(SERVICE, OPTIONS["host"], OPTIONS["port"])
@@ -3,17 +3,30 @@
 
     The predictor function can be added also in this module (see the baseline predictor as example)
 
-    The predictor function takes a class image as an input and outputs a labeled image as the output
+    The predictor function takes a class image (its path, a packed_dataset.PackedImage or its decoded array, of any
+    height and width) as an input
+    and outputs a labeled image as the output
 
 """
 import numpy as np
-import skimage.io
-import skimage.morphology
-import random
+import scipy.ndimage
+import skimage.segmentation
+
+import artifact_cache
+import instrumentation
+import prediction_store
+import propagation
+import shared_resources as shres
+
+# Distance metric of the distance predictor for each connectivity (0 is vertices, 1 is edges)
+GRID_METRICS = {0: "chessboard", 1: "taxicab"}
 
 
 class Predictor:
-    """ Provides access to any number of predictor functions using a factory method """
+    """ Provides access to any number of predictor functions using a factory method. 'resources' can be a
+    shared_resources.Resources object or any object with the same predictor settings, such as
+    shared_resources.PredictorSettings
+    """
 
     def __init__(self, resources):
         self.resources = resources
@@ -21,146 +34,294 @@ class Predictor:
         # Add predictor names to this structure and add predictor code to the bottom of the file
         self.options = {
             "baseline": baseline_predictor,
-            "pixel": pixel_method
+            "pixel": pixel_method,
+            "watershed": watershed_method,
+            "distance": distance_method,
+            "euclidean": euclidean_method
+        }
+
+        # Predictors that can start from the front end shared by several configurations (see predict_many). They
+        # take the labelled interior, the boundary mask, the predictor settings and the class image (for the
+        # probabilities, which are decoded once)
+        self.front_end_options = {
+            "baseline": baseline_from_front_end,
+            "pixel": pixel_from_front_end,
+            "watershed": watershed_from_front_end,
+            "distance": distance_from_front_end,
+            "euclidean": euclidean_from_front_end
         }
 
-    def predict(self):
+    def predict(self, class_image=None):
+        """ Runs the selected predictor on 'class_image' (a path or a decoded array). By default the class file of
+        the resources is used.
+        """
         # Check if the user-entered predictor is one of the defined options
         if self.resources.predictor not in self.options.keys():
             raise ValueError(self.resources.predictor)
 
-        # Invoke the selected predictor with the class file (path) as its argument
+        if class_image is None:
+            class_image = self.resources.class_file
+
+        return self.cached(class_image, lambda: self.run(class_image))
+
+    def predict_many(self, configurations, class_image=None):
+        """ Runs several predictor configurations (shared_resources.PredictorSettings or Resources objects) on one
+        class image. Decoding and argmax run once, cleanup and labelling of the interior once per cell_min_size; only
+        the boundary assignment runs for each configuration, and pixel method configurations that differ only in
+        their number of passes share it. Returns a dictionary of label images keyed by PredictorSettings.
+        """
+        if class_image is None:
+            class_image = self.resources.class_file
+
+        configurations = [Predictor(configuration).settings() for configuration in configurations]
+        front_ends = {}
+
+        # Configurations of the pixel method that differ only in their number of passes share one run of the engine
+        pass_counts = {}
+        for settings in configurations:
+            if settings.predictor == "pixel":
+                pass_counts.setdefault(settings._replace(passes=None), set()).add(settings.passes)
+        runs = {}
+
+        def front_end(cell_min_size):
+            if cell_min_size not in front_ends:
+                front_ends[cell_min_size] = interior_and_boundary(class_image, cell_min_size)
+            return front_ends[cell_min_size]
+
+        def from_front_end(settings):
+            run = settings._replace(passes=None)
+            if len(pass_counts.get(run, ())) > 1:
+                if run not in runs:
+                    runs[run] = propagation.snapshots_at(*front_end(settings.cell_min_size), pass_counts[run],
+                                                         borders=settings.borders, connectivity=settings.connectivity,
+                                                         engine=settings.engine, seed=settings.seed)
+                return runs[run][settings.passes]
+            return self.front_end_options[settings.predictor](*front_end(settings.cell_min_size), settings, class_image)
+
+        predictions = {}
+        for settings in configurations:
+            predictor = Predictor(settings)
+            if settings.predictor in self.front_end_options.keys():
+                predictions[settings] = predictor.cached(class_image, lambda: from_front_end(settings))
+            else:
+                predictions[settings] = predictor.predict(class_image)
+        return predictions
+
+    def cached(self, class_image, compute):
+        """ Returns the output of 'compute()' for 'class_image'. Outputs for class files are cached per configuration,
+        in memory and in the prediction store when it is enabled, unless they depend on unseeded random choices
+        """
+        if artifact_cache.is_file(class_image) and (not self.resources.borders or self.resources.seed is not None):
+            key = artifact_cache.file_key("prediction", class_image, self.settings())
+            return artifact_cache.CACHE.get(key, lambda: self.stored(class_image, compute))
+        return compute()
+
+    def stored(self, class_file, compute):
+        store = prediction_store.default_store()
+        if store is None:
+            return compute()
+        return store.get(class_file, self.settings(), compute)
+
+    def settings(self):
+        """ Predictor settings of the resources """
+        return shres.settings_of(self.resources)
+
+    def run(self, class_image):
+        with instrumentation.stage("predict", predictor=self.resources.predictor):
+            return self.invoke(class_image)
+
+    def invoke(self, class_image):
+        # Invoke the selected predictor with the class image as its argument
+        cell_min_size = self.resources.cell_min_size
         if self.resources.predictor == 'pixel':
-            return self.options[self.resources.predictor](self.resources.class_file, borders = self.resources.borders,
-                                                   connectivity=self.resources.connectivity, passes=self.resources.passes)
+            return self.options[self.resources.predictor](class_image, borders=self.resources.borders,
+                                                          connectivity=self.resources.connectivity,
+                                                          passes=self.resources.passes,
+                                                          engine=self.resources.engine,
+                                                          seed=self.resources.seed,
+                                                          cell_min_size=cell_min_size)
+        elif self.resources.predictor in ('distance', 'euclidean'):
+            return self.options[self.resources.predictor](class_image, borders=self.resources.borders,
+                                                          connectivity=self.resources.connectivity,
+                                                          passes=self.resources.passes,
+                                                          cell_min_size=cell_min_size)
+        elif self.resources.predictor == 'watershed':
+            return self.options[self.resources.predictor](class_image, borders=self.resources.borders,
+                                                          connectivity=self.resources.connectivity,
+                                                          cell_min_size=cell_min_size)
         else:
-            return self.options[self.resources.predictor](self.resources.class_file)
+            return self.options[self.resources.predictor](class_image, cell_min_size=cell_min_size)
 
 
-def baseline_predictor(class_image_path):
+def baseline_predictor(class_image, cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
     """ Initial implementation of a method that converts a class map into labeled segments"""
-    # Class image has 3 planes for background, interior, and boundaries. Each plan show the
-    # probability that the pixel belongs to the class
-    class_image_data = skimage.io.imread(class_image_path)
+    # The labelled interior of the nuclei is the prediction; boundary pixels stay as background
+    interior, _ = interior_and_boundary(class_image, cell_min_size)
+    return interior
 
-    # Each pixel in 'pred' gets the plane index (0, 1, of 2) for which the plane value (prob) is max
-    # Hence, pred is an image whose pixels have values 0 (background), 1 (interior) or 2 (boundary)
-    pred = np.argmax(class_image_data, -1)
 
-    cell_min_size = 25
-    cell_label = 1  # This value corresponds to the interior class
+def pixel_method(class_image, borders=0, connectivity=0, passes=None, engine="frontier", seed=None,
+                 cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
+    interior, boundary = interior_and_boundary(class_image, cell_min_size)
+
+    # Assign boundary pixels to the neighbouring interior labels with the selected propagation engine
+    return propagation.propagate(interior, boundary, borders=borders, connectivity=connectivity, passes=passes,
+                                 engine=engine, seed=seed)
+
+
+def watershed_method(class_image, borders=0, connectivity=0, cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
+    """ Grows the labelled interiors into the boundary pixels in increasing order of boundary probability, with a
+    single priority-queue flood (watershed). Each boundary pixel goes to the interior that reaches it first, so the
+    output is deterministic and does not depend on a number of passes. With borders=0 the pixels where two
+    interiors meet are left as background, which separates touching nuclei.
+    """
+    interior, boundary = interior_and_boundary(class_image, cell_min_size)
+    return flood(interior, boundary, read_class_image(class_image)[:, :, 2], borders=borders,
+                 connectivity=connectivity)
+
+
+def flood(interior, boundary, boundary_probability, borders=0, connectivity=0):
+    """ Watershed of watershed_method from its front end and the boundary probability plane """
+    with instrumentation.stage("watershed"):
+        # connectivity 0 floods through the pixel vertices (8 neighbours), 1 through the pixel edges (4 neighbours)
+        return skimage.segmentation.watershed(boundary_probability, markers=interior, mask=(interior > 0) | boundary,
+                                              connectivity=2 - connectivity, watershed_line=not borders)
 
-    # 'cell' is an image that contains only interior
-    cell = (pred == cell_label)
 
-    # Remove small holes and small objects from 'cell'
-    cell = skimage.morphology.remove_small_holes(cell, area_threshold=cell_min_size)
-    cell = skimage.morphology.remove_small_objects(cell, min_size=cell_min_size)
+def distance_method(class_image, borders=0, connectivity=0, passes=None, cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
+    """ One-shot approximation of the pixel_method: every boundary pixel takes the label of the nearest interior pixel
+    in chessboard (connectivity=0) or taxicab (connectivity=1) distance. The distance is measured through any pixel,
+    background included, while the pixel method only grows through boundary pixels, so a few pixels (about 1% on
+    SmallEval) get a different label. 'passes' is the largest distance that is assigned. Ties between labels follow
+    the 'borders' rule, without random choices: borders=1 keeps the label found by the distance transform
+    """
+    interior, boundary = interior_and_boundary(class_image, cell_min_size)
+    return propagation.assign_nearest(interior, boundary, borders=borders, metric=GRID_METRICS[connectivity],
+                                      max_distance=passes)
 
-    # Convert the 'cell' image into an image that contains labels (one label for each segmented nucleus)
-    [label, _] = skimage.morphology.label(cell, return_num=True)
-    label[np.where(label != 0)] += 1
-    return label
 
+def euclidean_method(class_image, borders=0, connectivity=0, passes=None, cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
+    """ Same as distance_method with the exact Euclidean distance. 'connectivity' is not used """
+    interior, boundary = interior_and_boundary(class_image, cell_min_size)
+    return propagation.assign_nearest(interior, boundary, borders=borders, metric="euclidean", max_distance=passes)
 
-def pixel_method(class_image_path, borders=0, connectivity=0, passes=None):
+
+def baseline_from_front_end(interior, boundary, settings, class_image=None):
+    return interior.copy()
+
+
+def pixel_from_front_end(interior, boundary, settings, class_image=None):
+    return propagation.propagate(interior, boundary, borders=settings.borders, connectivity=settings.connectivity,
+                                 passes=settings.passes, engine=settings.engine, seed=settings.seed)
+
+
+def watershed_from_front_end(interior, boundary, settings, class_image):
+    return flood(interior, boundary, read_class_image(class_image)[:, :, 2], borders=settings.borders,
+                 connectivity=settings.connectivity)
+
+
+def distance_from_front_end(interior, boundary, settings, class_image=None):
+    return propagation.assign_nearest(interior, boundary, borders=settings.borders,
+                                      metric=GRID_METRICS[settings.connectivity], max_distance=settings.passes)
+
+
+def euclidean_from_front_end(interior, boundary, settings, class_image=None):
+    return propagation.assign_nearest(interior, boundary, borders=settings.borders, metric="euclidean",
+                                      max_distance=settings.passes)
+
+
+def pixel_method_snapshots(class_image, max_passes, borders=0, connectivity=0, engine="frontier", seed=None,
+                           cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
+    """ Yields the output of the pixel_method for passes = 0, 1, ..., max_passes from a single run """
+    interior, boundary = interior_and_boundary(class_image, cell_min_size)
+    return propagation.snapshots(interior, boundary, max_passes, borders=borders, connectivity=connectivity,
+                                 engine=engine, seed=seed)
+
+
+def interior_and_boundary(class_image, cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
+    """ Front end shared by the predictors. Returns the labelled interior of the nuclei and the mask of boundary
+    pixels. Interior objects and holes of 'cell_min_size' pixels or fewer are removed
+    """
     # Class image has 3 planes for background, interior, and boundaries. Each plan show the
     # probability that the pixel belongs to the class
-    class_image_data = skimage.io.imread(class_image_path)
 
     # Each pixel in 'pred' gets the plane index (0, 1, of 2) for which the plane value (prob) is max
     # Hence, pred is an image whose pixels have values 0 (background), 1 (interior) or 2 (boundary)
-    pred = np.argmax(class_image_data, -1)
+    pred = class_argmax(class_image)
 
-    cell_min_size = 25
     cell_label = 1  # This value corresponds to the interior class
 
-    # 'cell' is an image that contains only interior
-    cell = (pred == cell_label)
+    with instrumentation.stage("cleanup"):
+        # 'cell' is an image that contains only interior
+        cell = (pred == cell_label)
 
-    # Remove small holes and small objects from 'cell'
-    cell = skimage.morphology.remove_small_holes(cell, area_threshold=cell_min_size)
-    cell = skimage.morphology.remove_small_objects(cell, min_size=cell_min_size)
+        # Remove small holes and small objects from 'cell'
+        cell = fill_small_holes(cell, cell_min_size)
+        cell = remove_small_objects(cell, cell_min_size)
 
-    # Convert the 'cell' image into an image that contains labels (one label for each segmented nucleus)
-    [interior, _] = skimage.morphology.label(cell, return_num=True, background=0)
-    interior[np.where(interior != 0)] += 1
+    with instrumentation.stage("label"):
+        # Convert the 'cell' image into an image that contains labels (one label for each segmented nucleus)
+        # Same as skimage.measure.label(cell, return_num=True), which imports skimage.morphology for boolean images
+        [interior, num_labels] = scipy.ndimage.label(cell, structure=np.ones((3, 3), dtype=bool))
+        interior = compact_labels(interior, num_labels + 1)
+        np.add(interior, 1, out=interior, where=interior != 0)
     boundary = (pred == 2)
-    final = interior.copy()
-    flag = True
-    counter = 0
-    while flag:
-        counter += 1
-        if passes is not None:
-            if counter == passes + 1:
-                break
-        changes = np.zeros((256, 256))
-        flag = False
-        # goes through every pixel in image
-        for y in range(0, 256):
-            for x in range(0, 256):
-                # only processes contour pixels
-                if boundary[y][x]:
-                    # stores different labels in neighborhood
-                    labels = set()
-                    # determines type of connectivity to use
-                    if connectivity:
-                        neighbors = neighbors_edges(y, x)
-                    else:
-                        neighbors = neighbors_vertices(y, x)
-                    # adds each label to labels set
-                    for pixel in neighbors_vertices(y, x):
-                        if final[pixel] > 0:
-                            flag = True
-                            labels.add(final[pixel])
-                    # if pixel neighbor does not have any labeled image regions, continue to next pixel
-                    if not labels:
-                        continue
-                    # make sure we do not process this pixel again
-                    boundary[y, x] = False
-                    labels = list(labels)
-                    # determines whether to separate borders
-                    if len(labels) > 1:
-                        if borders:
-                            # picks a random label from the list of labels
-                            changes[y, x] = labels[random.randint(0, len(labels) - 1)]
-                        else:
-                            changes[y, x] = 0
-                    else:
-                        changes[y, x] = labels[0]
-        # changed pixels are stored in a temporary array
-        # at the end of each pass, the we update the final image with the changes
-        mask = (changes > 0)
-        final[mask] = changes[mask]
-
-    return final
-
-
-def neighbors_vertices(y, x):
-    calculate_neighbors = lambda y, x: [(i, j) for i in range(y - 1, y + 2)
-                      for j in range(x - 1, x + 2)
-                      if (0 <= x < 256 and
-                          0 <= y < 256 and
-                          (i != y or j != x)
-                          and (0 <= i < 256)
-                          and (0 <= j < 256))]
-    all_neighbors = calculate_neighbors(y, x)
-    all_neighbors.append((y, x))
-    return all_neighbors
-
-
-def neighbors_edges(y, x):
-    n = lambda y, x: [(i, j) for i in range(y - 1, y + 2)
-                      for j in range(x - 1, x + 2)
-                      if (0 <= x < 256 and
-                          0 <= y < 256 and
-                          (i != y or j != x) and
-                          (i != y-1 or j != x-1) and
-                          (i != y+1 or j != x+1) and
-                          (i != y-1 or j != x+1) and
-                          (i != y+1 or j != x-1)
-                          and (0 <= i < 256)
-                          and (0 <= j < 256))]
-    all_neighbors = n(y, x)
-    all_neighbors.append((y, x))
-    return all_neighbors
+    return interior, boundary
+
+
+def remove_small_objects(mask, max_size):
+    """ Removes the edge-connected objects of 'mask' that have 'max_size' pixels or fewer. Same as
+    skimage.morphology.remove_small_objects(mask, max_size=max_size), without importing skimage.morphology, which is
+    slow to import
+    """
+    components, _ = scipy.ndimage.label(mask)
+    small = np.bincount(components.ravel(), minlength=1) <= max_size
+    small[0] = False
+    return mask & ~small[components]
+
+
+def fill_small_holes(mask, max_size):
+    """ Fills the edge-connected holes of 'mask' that have 'max_size' pixels or fewer. Same as
+    skimage.morphology.remove_small_holes(mask, max_size=max_size)
+    """
+    return ~remove_small_objects(~mask, max_size)
+
+
+def compact_labels(labels, max_label=None):
+    """ Returns 'labels' in the smallest unsigned integer dtype that holds 'max_label' (by default the largest label)
+    and leaves its largest value free, which the propagation engines use as a sentinel
+    """
+    if max_label is None:
+        max_label = int(labels.max()) if labels.size else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label < np.iinfo(dtype).max:
+            return labels.astype(dtype, copy=False)
+    return labels.astype(np.uint64, copy=False)
+
+
+def read_class_image(class_image):
+    """ Returns the class image data given either the path to the class png or the already decoded array """
+    if isinstance(class_image, np.ndarray):
+        return class_image
+    return artifact_cache.read_image(class_image)
+
+
+def class_argmax(class_image):
+    """ Returns the index of the most probable class of every pixel. Cached when 'class_image' is a path """
+    if isinstance(class_image, np.ndarray):
+        return argmax(class_image)
+    return artifact_cache.CACHE.get(artifact_cache.file_key("argmax", class_image),
+                                    lambda: argmax(read_class_image(class_image)))
+
+
+@instrumentation.timed("argmax")
+def argmax(class_image):
+    """ Same as np.argmax(class_image, -1) (the first plane wins ties), as uint8 instead of int64 """
+    best = class_image[..., 0]
+    indices = np.zeros(class_image.shape[:-1], dtype=np.uint8)
+    for plane in range(1, class_image.shape[-1]):
+        values = class_image[..., plane]
+        greater = values > best
+        indices[greater] = plane
+        best = np.where(greater, values, best)
+    return indices
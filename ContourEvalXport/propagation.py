@@ -0,0 +1,461 @@
+""" Boundary propagation engines used by the pixel predictor. An engine takes the labelled interior of the
+    nuclei and the mask of boundary pixels, and assigns boundary pixels to the labels of their neighbours,
+    one ring of pixels per pass.
+
+    Engines are listed in the ENGINES dictionary, which links the engine name with its function. The functions are
+    generators that yield the label image after every pass that changed it, so a single run gives the result of
+    every pass count. Use propagate() to stop after a given number of passes.
+        "python": the original per-pixel loop. Builds Python objects for every pixel, so it is only practical
+                  for small crops
+        "numpy": every pass is done with whole-array operations. Gives pixel-identical output to the
+                 python engine for borders=0
+        "frontier": keeps a queue of the boundary pixels next to the pixels labelled in the previous pass, so
+                    the work per pass scales with the frontier instead of the image area. Gives the same output
+                    as the numpy engine. This is the default engine
+        "numba": the frontier engine with each pass compiled by numba, so no Python object is built per pixel.
+                 Gives the same output as the frontier engine, also for borders=1 with the same seed. numba is
+                 optional; without it this engine warns once and runs the frontier engine
+
+    With borders=1, conflicts are broken at random. Passing the same 'seed' to an engine makes its output repeatable.
+
+    assign_nearest() is a one-shot alternative to the engines: a distance transform gives every boundary pixel the
+    label of its nearest interior pixel, without iterating over passes.
+"""
+import random
+import itertools
+import warnings
+import functools
+import importlib.util
+import numpy as np
+import scipy.ndimage
+
+# numba is slow to import, so it is only imported when the numba engine first runs (see load_numba)
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None
+numba = None
+
+import instrumentation
+
+# The reference loop collects labels from the vertex neighbourhood (3x3 block) of a pixel whatever the
+# connectivity, so every engine scans the same footprint to keep the outputs identical
+SCAN_FOOTPRINT = np.ones((3, 3), dtype=bool)
+
+
+def iterate_python(interior, boundary, borders=0, connectivity=0, seed=None):
+    """ Original implementation: visits every pixel of the image on every pass """
+    height, width = interior.shape
+    rng = random.Random(seed)
+    boundary = boundary.copy()
+    final = interior.copy()
+    flag = True
+    while flag:
+        changes = np.zeros((height, width), dtype=final.dtype)
+        flag = False
+        # goes through every pixel in image
+        for y in range(0, height):
+            for x in range(0, width):
+                # only processes contour pixels
+                if boundary[y][x]:
+                    # stores different labels in neighborhood
+                    labels = set()
+                    # determines type of connectivity to use
+                    if connectivity:
+                        neighbors = neighbors_edges(y, x, height, width)
+                    else:
+                        neighbors = neighbors_vertices(y, x, height, width)
+                    # adds each label to labels set
+                    for pixel in neighbors_vertices(y, x, height, width):
+                        if final[pixel] > 0:
+                            flag = True
+                            labels.add(final[pixel])
+                    # if pixel neighbor does not have any labeled image regions, continue to next pixel
+                    if not labels:
+                        continue
+                    # make sure we do not process this pixel again
+                    boundary[y, x] = False
+                    labels = list(labels)
+                    # determines whether to separate borders
+                    if len(labels) > 1:
+                        if borders:
+                            # picks a random label from the list of labels
+                            changes[y, x] = labels[rng.randint(0, len(labels) - 1)]
+                        else:
+                            changes[y, x] = 0
+                    else:
+                        changes[y, x] = labels[0]
+        # changed pixels are stored in a temporary array
+        # at the end of each pass, the we update the final image with the changes
+        mask = (changes > 0)
+        final[mask] = changes[mask]
+        if flag:
+            yield final
+
+
+def iterate_numpy(interior, boundary, borders=0, connectivity=0, seed=None):
+    """ Vectorized implementation: each pass finds the largest and the smallest positive label around every pixel
+    with max/min filters. Boundary pixels with at least one labelled neighbour take the label when both agree, and
+    are ambiguous when they do not.
+    """
+    rng = np.random.default_rng(seed)
+    boundary = boundary.copy()
+    final = interior.copy()
+    sentinel = np.iinfo(final.dtype).max
+    while True:
+        upper = scipy.ndimage.maximum_filter(final, footprint=SCAN_FOOTPRINT, mode='constant', cval=0)
+        lower = scipy.ndimage.minimum_filter(np.where(final > 0, final, sentinel), footprint=SCAN_FOOTPRINT,
+                                             mode='constant', cval=sentinel)
+
+        # boundary pixels that have at least one labelled neighbour are processed only once
+        active = boundary & (upper > 0)
+        if not active.any():
+            return
+        boundary &= ~active
+
+        ambiguous = active & (lower != upper)
+        changes = np.where(active & ~ambiguous, upper, 0)
+        if borders and ambiguous.any():
+            indices = np.flatnonzero(ambiguous)
+            changes.flat[indices] = pick_random_labels(gather_neighbourhoods(final, indices), rng)
+
+        mask = (changes > 0)
+        final[mask] = changes[mask]
+        yield final
+
+
+def iterate_frontier(interior, boundary, borders=0, connectivity=0, seed=None):
+    """ Frontier implementation: only the boundary pixels next to the pixels labelled in the previous pass can
+    change, so each pass gathers the neighbourhoods of those pixels alone. The images are padded with one pixel
+    of background to avoid bounds checks on the flat indices.
+    """
+    rng = np.random.default_rng(seed)
+    final = np.pad(interior, 1)
+    pending = np.pad(boundary, 1)
+    flat_final = final.ravel()
+    flat_pending = pending.ravel()
+    offsets = neighbourhood_offsets(final.shape[1])
+    sentinel = np.iinfo(final.dtype).max
+
+    def expand(indices):
+        """ Unprocessed boundary pixels in the neighbourhood of 'indices' """
+        candidates = (indices[:, None] + offsets).ravel()
+        return np.unique(candidates[flat_pending[candidates]])
+
+    # The first frontier holds every boundary pixel next to a labelled interior pixel
+    frontier = np.flatnonzero(pending & scipy.ndimage.binary_dilation(final > 0, structure=SCAN_FOOTPRINT))
+    while frontier.size:
+        instrumentation.count("frontier", frontier.size)
+        # every frontier pixel has at least one labelled neighbour, so all of them are processed in this pass
+        neighbourhoods = flat_final[frontier[:, None] + offsets]
+        upper = neighbourhoods.max(axis=1)
+        lower = np.where(neighbourhoods > 0, neighbourhoods, sentinel).min(axis=1)
+        flat_pending[frontier] = False
+
+        ambiguous = (lower != upper)
+        changes = np.where(ambiguous, 0, upper)
+        if borders and ambiguous.any():
+            changes[ambiguous] = pick_random_labels(neighbourhoods[ambiguous], rng)
+
+        labelled = frontier[changes > 0]
+        flat_final[labelled] = changes[changes > 0]
+        frontier = expand(labelled)
+        yield final[1:-1, 1:-1]
+
+
+def iterate_numba(interior, boundary, borders=0, connectivity=0, seed=None):
+    """ Compiled frontier implementation: the same passes as iterate_frontier, with every pass done by two numba
+    kernels. The random numbers for borders=1 are drawn in the same order as in iterate_frontier.
+    """
+    if load_numba() is None:
+        warn_numba_missing()
+        yield from iterate_frontier(interior, boundary, borders=borders, connectivity=connectivity, seed=seed)
+        return
+
+    rng = np.random.default_rng(seed)
+    final = np.pad(interior, 1)
+    pending = np.pad(boundary, 1)
+    flat_final = final.ravel()
+    flat_pending = pending.ravel()
+    offsets = neighbourhood_offsets(final.shape[1])
+    marks = np.zeros(flat_final.size, dtype=np.bool_)
+
+    frontier = np.flatnonzero(pending & scipy.ndimage.binary_dilation(final > 0, structure=SCAN_FOOTPRINT))
+    while frontier.size:
+        instrumentation.count("frontier", frontier.size)
+        changes = np.empty(frontier.size, dtype=final.dtype)
+        ambiguous = np.empty(frontier.size, dtype=np.bool_)
+        num_ambiguous = scan_frontier(flat_final, flat_pending, frontier, offsets, changes, ambiguous)
+        draws = rng.random(num_ambiguous) if borders and num_ambiguous else np.empty(0)
+        frontier = apply_frontier(flat_final, flat_pending, frontier, offsets, changes, ambiguous, draws, marks)
+        yield final[1:-1, 1:-1]
+
+
+def warn_numba_missing():
+    warnings.warn("numba is not installed; the numba engine runs the frontier engine instead", stacklevel=3)
+
+
+def load_numba():
+    """ Imports numba on first use. Returns None when it is not installed """
+    global numba
+    if numba is None and HAVE_NUMBA:
+        import numba as module
+        numba = module
+    return numba
+
+
+def jit(function):
+    """ Compiles 'function' with numba on its first call, when numba is installed """
+    compiled = []
+
+    @functools.wraps(function)
+    def kernel(*args):
+        if not compiled:
+            compiled.append(function if load_numba() is None else numba.njit(cache=True, nogil=True)(function))
+        return compiled[0](*args)
+    return kernel
+
+
+@jit
+def scan_frontier(flat_final, flat_pending, frontier, offsets, changes, ambiguous):
+    """ Finds the new label of every frontier pixel from the labels around it, and marks the pixels whose
+    neighbours disagree as ambiguous. Returns the number of ambiguous pixels
+    """
+    num_ambiguous = 0
+    for i in range(frontier.size):
+        centre = frontier[i]
+        upper = 0
+        lower = 0
+        for offset in offsets:
+            label = flat_final[centre + offset]
+            if label > 0:
+                if upper == 0 or label > upper:
+                    upper = label
+                if lower == 0 or label < lower:
+                    lower = label
+        flat_pending[centre] = False
+        ambiguous[i] = lower != upper
+        changes[i] = 0 if lower != upper else upper
+        num_ambiguous += ambiguous[i]
+    return num_ambiguous
+
+
+@jit
+def apply_frontier(flat_final, flat_pending, frontier, offsets, changes, ambiguous, draws, marks):
+    """ Picks the labels of the ambiguous pixels from 'draws' (when given), writes the changes of the pass and
+    returns the sorted frontier of the next pass
+    """
+    if draws.size:
+        labels = np.empty(offsets.size, dtype=flat_final.dtype)
+        draw = 0
+        for i in range(frontier.size):
+            if not ambiguous[i]:
+                continue
+            for k in range(offsets.size):
+                labels[k] = flat_final[frontier[i] + offsets[k]]
+            labels.sort()
+            # Same choice as pick_random_labels: the distinct positive labels in increasing order
+            num_distinct = 0
+            for k in range(labels.size):
+                if labels[k] > 0 and (k == 0 or labels[k] != labels[k - 1]):
+                    num_distinct += 1
+            choice = int(draws[draw] * num_distinct)
+            draw += 1
+            for k in range(labels.size):
+                if labels[k] > 0 and (k == 0 or labels[k] != labels[k - 1]):
+                    if choice == 0:
+                        changes[i] = labels[k]
+                        break
+                    choice -= 1
+
+    next_frontier = np.empty(frontier.size * offsets.size, dtype=frontier.dtype)
+    size = 0
+    for i in range(frontier.size):
+        if changes[i] > 0:
+            flat_final[frontier[i]] = changes[i]
+            for offset in offsets:
+                candidate = frontier[i] + offset
+                if flat_pending[candidate] and not marks[candidate]:
+                    marks[candidate] = True
+                    next_frontier[size] = candidate
+                    size += 1
+    next_frontier = np.sort(next_frontier[:size])
+    for candidate in next_frontier:
+        marks[candidate] = False
+    return next_frontier
+
+
+def propagate(interior, boundary, borders=0, connectivity=0, passes=None, engine="frontier", seed=None):
+    """ Runs the selected engine for 'passes' passes, or until no boundary pixel changes when 'passes' is None """
+    if engine not in ENGINES.keys():
+        raise ValueError(engine)
+
+    if passes == 0:
+        return interior.copy()
+
+    final = interior
+    counter = 0
+    with instrumentation.stage("propagate", engine=engine):
+        for counter, final in enumerate(ENGINES[engine](interior, boundary, borders=borders,
+                                                        connectivity=connectivity, seed=seed), 1):
+            if counter == passes:
+                break
+    instrumentation.count("passes", counter)
+    return np.ascontiguousarray(final)
+
+
+def snapshots(interior, boundary, max_passes, borders=0, connectivity=0, engine="frontier", seed=None):
+    """ Yields a copy of the label image after 0, 1, ..., max_passes passes from a single run of the engine. The
+    snapshot for k passes is identical to propagate(..., passes=k) with the same seed.
+    """
+    if engine not in ENGINES.keys():
+        raise ValueError(engine)
+
+    final = interior
+    yield final.copy()
+    passes = ENGINES[engine](interior, boundary, borders=borders, connectivity=connectivity, seed=seed)
+    running = True
+    for counter in range(1, max_passes + 1):
+        if running:
+            # Only the pass is timed, not the work of the caller between two snapshots
+            with instrumentation.stage("propagate", engine=engine):
+                step = next(passes, None)
+            # Once the engine stops, later passes would not change the image
+            running = step is not None
+            if running:
+                final = step
+                instrumentation.count("passes", counter)
+        yield final.copy()
+
+
+def snapshots_at(interior, boundary, pass_counts, borders=0, connectivity=0, engine="frontier", seed=None):
+    """ Returns a dictionary with a copy of the label image after each number of passes of 'pass_counts' (None for
+    the image at convergence), from a single run of the engine. Each image is identical to propagate(...,
+    passes=k) with the same seed.
+    """
+    if engine not in ENGINES.keys():
+        raise ValueError(engine)
+
+    images = {}
+    final = interior
+    counter = 0
+    with instrumentation.stage("propagate", engine=engine):
+        passes = ENGINES[engine](interior, boundary, borders=borders, connectivity=connectivity, seed=seed)
+        for count in sorted(count for count in set(pass_counts) if count is not None):
+            for final in itertools.islice(passes, count - counter):
+                counter += 1
+            # Once the engine stops, later passes would not change the image
+            images[count] = np.array(final)
+        if None in pass_counts:
+            for final in passes:
+                counter += 1
+            images[None] = np.array(final)
+    instrumentation.count("passes", counter)
+    return images
+
+
+def assign_nearest(interior, boundary, borders=0, metric="chessboard", max_distance=None):
+    """ Gives every boundary pixel the label of the nearest labelled interior pixel under 'metric' ('chessboard',
+    'taxicab' or 'euclidean'), using a distance transform with feature indices. Boundary pixels farther than
+    'max_distance' stay unlabelled. With borders=0, a pixel is left as background when a strictly closer pixel in
+    its 3x3 neighbourhood belongs to another label, which is where two labels meet at equal distance. The neighbours
+    are compared with their labels before any conflict is cleared.
+
+    The distance is measured through every pixel, not only through boundary pixels, so this approximates the rings
+    of the pixel method rather than reproducing them.
+    """
+    final = interior.copy()
+    if not interior.any():
+        return final
+
+    with instrumentation.stage("distance transform", metric=metric):
+        if metric == "euclidean":
+            distance, indices = scipy.ndimage.distance_transform_edt(interior == 0, return_indices=True)
+        else:
+            distance, indices = scipy.ndimage.distance_transform_cdt(interior == 0, metric=metric,
+                                                                     return_indices=True)
+
+    assigned = boundary if max_distance is None else boundary & (distance <= max_distance)
+    rows, cols = np.nonzero(assigned)
+    labels = interior[indices[0][rows, cols], indices[1][rows, cols]]
+    final[rows, cols] = labels
+
+    if not borders:
+        # Compare every assigned pixel with its neighbours. Unlabelled pixels, and pixels outside the image, are
+        # never closer
+        unlabelled = np.inf if metric == "euclidean" else np.iinfo(distance.dtype).max
+        padded_labels = np.pad(final, 1)
+        padded_distance = np.pad(np.where(final > 0, distance, unlabelled), 1, constant_values=unlabelled)
+        centres = (rows + 1) * padded_labels.shape[1] + cols + 1
+        own_distance = distance[rows, cols]
+        conflicts = np.zeros(len(centres), dtype=bool)
+        for offset in neighbourhood_offsets(padded_labels.shape[1]):
+            neighbours = padded_labels.ravel()[centres + offset]
+            closer = padded_distance.ravel()[centres + offset] < own_distance
+            conflicts |= closer & (neighbours > 0) & (neighbours != labels)
+        final[rows[conflicts], cols[conflicts]] = 0
+    return final
+
+
+def gather_neighbourhoods(final, indices):
+    """ Returns one row per pixel in 'indices' (flat indices into 'final') with the labels in its neighbourhood.
+    Pixels outside the image count as background.
+    """
+    width = final.shape[1]
+    padded = np.pad(final, 1)
+    rows, cols = np.divmod(indices, width)
+    centres = (rows + 1) * (width + 2) + cols + 1
+    return padded.ravel()[centres[:, None] + neighbourhood_offsets(width + 2)]
+
+
+def pick_random_labels(neighbourhoods, rng):
+    """ Picks, for each row of 'neighbourhoods', one of its distinct positive labels with equal probability """
+    candidates = np.sort(neighbourhoods, axis=1)
+
+    # a candidate is distinct when it is positive and differs from the previous one in its sorted row
+    distinct = candidates > 0
+    distinct[:, 1:] &= candidates[:, 1:] != candidates[:, :-1]
+    rank = np.cumsum(distinct, axis=1) - 1
+    choice = (rng.random(len(candidates)) * distinct.sum(axis=1)).astype(np.intp)
+    return candidates[distinct & (rank == choice[:, None])]
+
+
+def neighbourhood_offsets(row_stride, footprint=SCAN_FOOTPRINT):
+    """ Flat index offsets of the pixels covered by a 3x3 footprint in an array with 'row_stride' columns """
+    dy, dx = np.nonzero(footprint)
+    return (dy - 1) * row_stride + (dx - 1)
+
+
+def neighbors_vertices(y, x, height, width):
+    calculate_neighbors = lambda y, x: [(i, j) for i in range(y - 1, y + 2)
+                      for j in range(x - 1, x + 2)
+                      if (0 <= x < width and
+                          0 <= y < height and
+                          (i != y or j != x)
+                          and (0 <= i < height)
+                          and (0 <= j < width))]
+    all_neighbors = calculate_neighbors(y, x)
+    all_neighbors.append((y, x))
+    return all_neighbors
+
+
+def neighbors_edges(y, x, height, width):
+    n = lambda y, x: [(i, j) for i in range(y - 1, y + 2)
+                      for j in range(x - 1, x + 2)
+                      if (0 <= x < width and
+                          0 <= y < height and
+                          (i != y or j != x) and
+                          (i != y-1 or j != x-1) and
+                          (i != y+1 or j != x+1) and
+                          (i != y-1 or j != x+1) and
+                          (i != y+1 or j != x-1)
+                          and (0 <= i < height)
+                          and (0 <= j < width))]
+    all_neighbors = n(y, x)
+    all_neighbors.append((y, x))
+    return all_neighbors
+
+
+ENGINES = {
+    "python": iterate_python,
+    "numpy": iterate_numpy,
+    "frontier": iterate_frontier,
+    "numba": iterate_numba
+}
@@ -0,0 +1,57 @@
+""" Append-only results file for long evaluations. Each line is a JSON object: the first one records the options
+of the run, every other one is the result row of one image. Rows are flushed to disk as soon as they are
+computed, so an interrupted run can be resumed from the last completed image.
+"""
+
+import os
+import json
+
+
+class ResultsFile:
+    """ JSON-lines file with one result row per image, keyed by the row's "ID" """
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            with open(path, 'w') as f:
+                f.write(json.dumps({"options": options}) + '\n')
+            return
+
+        # Drop a partial last line left by an interrupted run, and check the run used the same options
+        valid_size = 0
+        header = None
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                if header is None:
+                    header = record
+                valid_size += len(line)
+        if header is None or header.get("options") != options:
+            raise ValueError("Results file {} was written with different options: {}".format(path, header))
+        if valid_size < os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def rows(self):
+        """ Yields the stored result rows one at a time """
+        with open(self.path) as f:
+            next(f)
+            for line in f:
+                yield json.loads(line)
+
+    def completed(self):
+        """ Returns the IDs of the images that already have a result row """
+        return {row["ID"] for row in self.rows()}
+
+    def append(self, row):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,252 @@
+""" Searches the parameters of the predictors (predictor name, borders, connectivity, passes and cell_min_size) for
+the best mean Jaccard index and F1 score over a dataset, and writes a ranked leaderboard of the configurations.
+
+The search evaluates the full grid of the given values, or a random sample of it (-n). Parameters that a predictor
+does not use keep their default value, so equivalent configurations are evaluated once. The configurations of one
+image share the decoding and cleanup of its class image, and pixel method configurations that differ only in their
+number of passes share one run of the engine (see predictors.Predictor.predict_many). Images are evaluated in
+parallel by the pipeline of the batch drivers.
+
+The images are evaluated in rungs: first -mi images, then twice as many, and so on. After each rung, configurations
+that another configuration beats on both the Jaccard index and the F1 score, by more than -z standard errors of the
+paired differences over the images evaluated so far, are pruned and not evaluated on the remaining images.
+"""
+
+import os
+import random
+import argparse
+import functools
+import itertools
+import numpy as np
+
+import dataset_index
+import evaluate_new_method as evaluate
+import instrumentation
+import pipeline
+import shared_resources as shres
+import predictors as pred
+import show_eval as eval
+
+# Parameters that change the output of each predictor. The pixel method scans the 3x3 neighbourhood whatever the
+# connectivity (see propagation.SCAN_FOOTPRINT)
+PREDICTOR_PARAMETERS = {
+    'baseline': ['cell_min_size'],
+    'pixel': ['borders', 'passes', 'cell_min_size'],
+    'watershed': ['borders', 'connectivity', 'cell_min_size'],
+    'distance': ['borders', 'connectivity', 'passes', 'cell_min_size'],
+    'euclidean': ['borders', 'passes', 'cell_min_size']
+}
+LEADERBOARD_COLUMNS = ['predictor', 'borders', 'connectivity', 'passes', 'cell_min_size', 'jaccard', 'f1', 'images']
+
+
+def parse_passes(value):
+    """ Number of passes, or None for 'none' (until convergence) """
+    return None if value.lower() == "none" else int(value)
+
+
+def parse_arguments():
+    describe = "searches the predictor parameters for the best mean Jaccard index and F1 score and outputs a " \
+               "leaderboard"
+    parser = argparse.ArgumentParser(description=describe)
+    required = parser.add_argument_group("required arguments")
+
+    help_r = "root directory containing images, classes, and annotations"
+    required.add_argument("-r", "--root_dir", help=help_r, type=str, required=False, default="SmallEval")
+
+    help_o = "output file for the leaderboard"
+    required.add_argument("-o", "--output_file", help=help_o, type=str, required=True)
+
+    help_p = "predictor names to search"
+    parser.add_argument("-p", "--predictors", help=help_p, type=str, nargs="+", required=False, default=["pixel"])
+
+    help_b = "values of borders to search (0 separates borders, 1 joins them)"
+    parser.add_argument("-b", "--borders", help=help_b, type=int, nargs="+", required=False, default=[0, 1])
+
+    help_c = "values of connectivity to search (0 is vertices, 1 is edges)"
+    parser.add_argument("-c", "--connectivity", help=help_c, type=int, nargs="+", required=False, default=[0, 1])
+
+    help_pa = "numbers of passes to search; 'none' runs until convergence"
+    parser.add_argument("-pa", "--passes", help=help_pa, type=parse_passes, nargs="+", required=False,
+                        default=[None])
+
+    help_cs = "values of cell_min_size to search"
+    parser.add_argument("-cs", "--cell_min_size", help=help_cs, type=int, nargs="+", required=False,
+                        default=[shres.DEFAULT_CELL_MIN_SIZE])
+
+    help_e = "propagation engine of the pixel method"
+    parser.add_argument("-e", "--engine", help=help_e, type=str, required=False, default="frontier")
+
+    help_n = "number of configurations sampled at random from the grid. Default is the full grid"
+    parser.add_argument("-n", "--samples", help=help_n, type=int, required=False, default=None)
+
+    help_s = "seed of the random sample of the grid and of the random choices made when borders are joined. Each " \
+             "image gets its own seed derived from it"
+    parser.add_argument("-s", "--seed", help=help_s, type=int, required=False, default=0)
+
+    help_mi = "number of images of the first rung, after which dominated configurations are first pruned"
+    parser.add_argument("-mi", "--min_images", help=help_mi, type=int, required=False, default=5)
+
+    help_z = "standard errors by which a configuration must be beaten on both scores to be pruned. 'inf' " \
+             "evaluates every configuration on every image"
+    parser.add_argument("-z", "--z_score", help=help_z, type=float, required=False, default=3.0)
+
+    help_w = "number of worker processes. Default is the number of CPUs"
+    parser.add_argument("-w", "--workers", help=help_w, type=int, required=False, default=os.cpu_count())
+    pipeline.add_pipeline_arguments(parser)
+    dataset_index.add_selection_arguments(parser)
+    shres.add_store_argument(parser)
+    shres.add_trace_argument(parser)
+    args = parser.parse_args()
+    shres.enable_prediction_store(args.store_dir)
+    shres.enable_tracing(args.trace_file)
+    return {"root_dir": args.root_dir,
+            "output_file": args.output_file,
+            "space": {"predictor": args.predictors,
+                      "borders": args.borders,
+                      "connectivity": args.connectivity,
+                      "passes": args.passes,
+                      "cell_min_size": args.cell_min_size},
+            "engine": args.engine,
+            "samples": args.samples,
+            "seed": args.seed,
+            "min_images": args.min_images,
+            "z_score": args.z_score,
+            "workers": args.workers,
+            "queue_size": args.queue_size,
+            "io_threads": args.io_threads,
+            "ids": args.ids,
+            "id_range": args.id_range}
+
+
+def configurations(space, engine="frontier", samples=None, seed=0):
+    """ PredictorSettings of the grid of 'space' (a list of values for each of 'predictor', 'borders',
+    'connectivity', 'passes' and 'cell_min_size'), without duplicates. With 'samples', a random sample of the grid
+    """
+    grid = {}
+    for predictor in space["predictor"]:
+        if predictor not in PREDICTOR_PARAMETERS.keys():
+            raise ValueError(predictor)
+        parameters = PREDICTOR_PARAMETERS[predictor]
+        for values in itertools.product(*[space[parameter] for parameter in parameters]):
+            grid[shres.PredictorSettings(predictor=predictor, engine=engine, **dict(zip(parameters, values)))] = None
+    grid = list(grid.keys())
+    if samples is not None and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+
+def search_job(job):
+    """ Computes the Jaccard index and the mean F1 score of every configuration on one image. Runs in the worker
+    processes
+    """
+    root_dir, image_id, configurations = job
+    with instrumentation.image(image_id):
+        resources = shres.Resources(root_dir, image_index=image_id)
+        ground_truth = eval.load_ground_truth(resources.annot_file)
+        predictions = pred.Predictor(resources).predict_many(configurations)
+        scores = []
+        for settings in configurations:
+            jaccard, f1 = eval.object_scores(ground_truth, predictions[settings], eval.F1_THRESHOLDS)
+            scores.append((jaccard, f1.mean()))
+        return scores
+
+
+def rungs(image_count, min_images, prune=True):
+    """ Number of images evaluated after each rung: min_images, twice as many, ..., image_count """
+    stops = []
+    stop = max(min_images, 1) if prune else image_count
+    while stop < image_count:
+        stops.append(stop)
+        stop *= 2
+    return stops + [image_count]
+
+
+def dominated(scores, z_score):
+    """ Indices of the configurations beaten on every score by another configuration. 'scores' has the shape
+    (configurations, images, scores); the mean of the paired differences over the images must exceed 'z_score'
+    standard errors
+    """
+    images = scores.shape[1]
+    if images < 2:
+        return []
+    indices = []
+    for index in range(len(scores)):
+        differences = scores - scores[index]
+        margin = differences.mean(axis=1) - z_score * differences.std(axis=1, ddof=1) / np.sqrt(images)
+        if np.any(np.all(margin > 0, axis=1)):
+            indices.append(index)
+    return indices
+
+
+def search(user_options):
+    """ Evaluates the configurations of the search space rung by rung, pruning dominated ones. Returns the
+    leaderboard
+    """
+    candidates = configurations(user_options["space"], engine=user_options.get("engine", "frontier"),
+                                samples=user_options.get("samples"), seed=user_options["seed"])
+    image_ids = shres.list_image_ids(user_options["root_dir"], pattern=user_options.get("ids"),
+                                     id_range=user_options.get("id_range"))
+    z_score = user_options.get("z_score", 3.0)
+
+    scores = {candidate: [] for candidate in candidates}
+    alive = list(candidates)
+    start = 0
+    for stop in rungs(len(image_ids), user_options.get("min_images", 5), prune=np.isfinite(z_score)):
+        # Each image is evaluated with its own seed, as in evaluate_new_method
+        def make_job(image_id, alive=tuple(alive)):
+            seed = evaluate.image_seed(user_options["seed"], image_id)
+            return user_options["root_dir"], image_id, [candidate._replace(seed=seed) for candidate in alive]
+
+        stages = [pipeline.Stage("read", evaluate.prefetch_job, "thread", user_options.get("io_threads", 4)),
+                  pipeline.Stage("evaluate", functools.partial(evaluate.run_prefetched, search_job), "process",
+                                 user_options["workers"] or 1)]
+        rows = pipeline.run_pipeline((make_job(image_id) for image_id in image_ids[start:stop]), stages,
+                                     queue_size=user_options.get("queue_size", 4))
+        for row in rows:
+            for candidate, score in zip(alive, row):
+                scores[candidate].append(score)
+        start = stop
+
+        if stop < len(image_ids):
+            pruned = set(dominated(np.array([scores[candidate] for candidate in alive]), z_score))
+            alive = [candidate for index, candidate in enumerate(alive) if index not in pruned]
+
+    return leaderboard(scores)
+
+
+def leaderboard(scores):
+    """ Table of the configurations ranked by the number of images they were evaluated on (pruned configurations
+    last), then by mean Jaccard index and mean F1 score. Parameters a predictor does not use are shown as '-'
+    """
+    # pandas is slow to import and only needed for the table, so worker processes never load it
+    import pandas as pd
+    rows = []
+    for settings, image_scores in scores.items():
+        if not image_scores:
+            continue
+        row = {column: '-' for column in LEADERBOARD_COLUMNS}
+        for parameter in ['predictor'] + PREDICTOR_PARAMETERS[settings.predictor]:
+            value = getattr(settings, parameter)
+            row[parameter] = 'none' if value is None else value
+        row['jaccard'], row['f1'] = np.mean(image_scores, axis=0)
+        row['images'] = len(image_scores)
+        rows.append(row)
+    table = pd.DataFrame(rows, columns=LEADERBOARD_COLUMNS)
+    table = table.sort_values(['images', 'jaccard', 'f1'], ascending=False, kind='stable').reset_index(drop=True)
+    table.index = table.index + 1
+    table.index.name = 'rank'
+    return table
+
+
+def output_leaderboard(user_options, table):
+    info = 'Configurations ranked by mean Jaccard index and mean F1 score (IoU thresholds 0.5 to 0.9).\n' \
+           'images is the number of images a configuration was evaluated on; fewer than the dataset means it was ' \
+           'pruned.\n\n'
+    evaluate.output_table(user_options, table, info)
+
+
+if __name__ == '__main__':
+    OPTIONS = parse_arguments()
+    TABLE = search(OPTIONS)
+    output_leaderboard(OPTIONS, TABLE)
+    print(TABLE.to_string())
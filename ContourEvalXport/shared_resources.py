@@ -2,19 +2,33 @@
 
 import os
 import argparse
-import skimage.morphology
-import skimage.io
-import numpy as np
+import collections
+
+import dataset_index
 
 CLASS_DIR_NAME = "Classes"
 ANNOT_DIR_NAME = "Annotations"
 IMAGES_DIR_NAME = "Images"
 DEFAULT_PREDICTOR = "baseline"
+# Interior objects and holes of this number of pixels or fewer are removed before labelling
+DEFAULT_CELL_MIN_SIZE = 25
+# Environment variable with the directory of the persistent prediction store (see prediction_store.py)
+STORE_ENV_VAR = "CONTOUR_PREDICTION_STORE"
+# Environment variable with the trace file of the instrumentation (see instrumentation.py)
+TRACE_ENV_VAR = "CONTOUR_TRACE_FILE"
+
+# Predictor name and parameters, without any file locations. Used when the class image does not belong to a dataset
+PredictorSettings = collections.namedtuple("PredictorSettings",
+                                           ["predictor", "borders", "connectivity", "passes", "engine", "seed",
+                                            "cell_min_size"],
+                                           defaults=[DEFAULT_PREDICTOR, 0, 0, None, "frontier", None,
+                                                     DEFAULT_CELL_MIN_SIZE])
 
 
 class Resources:
     """ Stores directory, file locations (paths) and other resources necessary to run contour evaluations. """
-    def __init__(self, root_dir, image_index=None, predictor_name='baseline', borders=0, connectivity=0, passes=None):
+    def __init__(self, root_dir, image_index=None, predictor_name='baseline', borders=0, connectivity=0, passes=None,
+                 engine="frontier", seed=None, cell_min_size=DEFAULT_CELL_MIN_SIZE):
         # Directory locations
         self.root_dir = root_dir
         self.class_dir = os.path.join(self.root_dir, CLASS_DIR_NAME)
@@ -32,21 +46,34 @@ class Resources:
         self.borders = borders
         self.connectivity = connectivity
         self.passes = passes
-
-        assert os.path.isdir(self.root_dir), "Unable to find {}".format(self.root_dir)
-        assert os.path.isdir(self.class_dir), "Unable to find {}".format(self.class_dir)
-        assert os.path.isdir(self.annot_dir), "Unable to find {}".format(self.annot_dir)
+        self.engine = engine
+        self.seed = seed
+        self.cell_min_size = cell_min_size
 
         if image_index is not None:
+            # Files are looked up in the index of the dataset instead of being checked one by one
+            dataset = dataset_index.open_index(self.root_dir)
             self.image_name = "{}_crop.png".format(image_index)
 
-            self.image_file = os.path.join(self.images_dir, self.image_name)
-            self.class_file = os.path.join(self.class_dir, self.image_name)
-            self.annot_file = os.path.join(self.annot_dir, self.image_name)
+            self.image_file = dataset.file(image_index, "images")
+            self.class_file = dataset.file(image_index, "classes")
+            self.annot_file = dataset.file(image_index, "annotations")
+
+            assert self.image_file is not None, "Unable to find image {} in {}".format(image_index, self.root_dir)
+            assert self.class_file is not None, "Unable to find class image {} in {}".format(image_index,
+                                                                                             self.root_dir)
+            assert self.annot_file is not None, "Unable to find annotation image {} in {}".format(image_index,
+                                                                                                  self.root_dir)
+
+    @property
+    def settings(self):
+        """ Predictor settings of these resources """
+        return settings_of(self)
 
-            assert os.path.isfile(self.image_file), "Unable to find image at {}".format(self.image_file)
-            assert os.path.isfile(self.class_file), "Unable to find class image at {}".format(self.class_file)
-            assert os.path.isfile(self.annot_file), "Unable to find annotation image at {}".format(self.annot_file)
+
+def settings_of(resources):
+    """ PredictorSettings of a Resources object, or of any object with the same predictor attributes """
+    return PredictorSettings(*[getattr(resources, field) for field in PredictorSettings._fields])
 
 
 
@@ -59,11 +86,11 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description=describe)
     required = parser.add_argument_group("reuired arguments")
 
-    help_r = "Root directory with {} and {} subdirectories".format(CLASS_DIR_NAME, ANNOT_DIR_NAME)
+    help_r = "Root directory with {} and {} subdirectories, or a packed dataset".format(CLASS_DIR_NAME, ANNOT_DIR_NAME)
     required.add_argument("-r", "--root_dir", help=help_r, type=str, required=True)
 
     help_i = "ID of image (the number that appears in its name)"
-    required.add_argument("-i", "--image_id", help=help_i, type=int, required=True)
+    required.add_argument("-i", "--image_id", help=help_i, type=str, required=True)
 
     help_p = "Predictor name. There is a default predictor invoked if this argument is not used"
     parser.add_argument("-p", "--predictor", help=help_p, type=str, default=None)
@@ -77,13 +104,66 @@ def parse_arguments():
 
     help_pa = "Counts how many passes the pixel_method does."
     parser.add_argument("-pa", "--passes", help=help_pa, type=int, default=None, required=False)
+
+    help_e = "Propagation engine used by the pixel_method ('python', 'numpy', 'frontier' or 'numba'). Default is " \
+             "'frontier'"
+    parser.add_argument("-e", "--engine", help=help_e, type=str, default="frontier", required=False)
+
+    help_s = "Seed of the random choices made when borders are joined. Default is a different choice on every run"
+    parser.add_argument("-s", "--seed", help=help_s, type=int, default=None, required=False)
+
+    help_cs = "Interior objects and holes of this number of pixels or fewer are removed before labelling. Default " \
+              "is {}".format(DEFAULT_CELL_MIN_SIZE)
+    parser.add_argument("-cs", "--cell_min_size", help=help_cs, type=int, default=DEFAULT_CELL_MIN_SIZE,
+                        required=False)
+
+    add_store_argument(parser)
+    add_trace_argument(parser)
     args = parser.parse_args()
+    enable_prediction_store(args.store_dir)
+    enable_tracing(args.trace_file)
 
     if args.predictor is None:
         resources_obj = Resources(root_dir=args.root_dir, image_index=args.image_id)
     else:
         resources_obj = Resources(root_dir=args.root_dir, image_index=args.image_id,
                                   predictor_name=args.predictor, borders=args.borders,
-                                  connectivity=args.connectivity, passes=args.passes)
+                                  connectivity=args.connectivity, passes=args.passes,
+                                  engine=args.engine, seed=args.seed, cell_min_size=args.cell_min_size)
 
     return resources_obj
+
+
+def list_image_ids(root_dir, pattern=None, id_range=None):
+    """ Sorted IDs of the images of the dataset at 'root_dir' (a directory of png files or a packed dataset),
+    optionally filtered by a glob pattern or an inclusive range of IDs (see dataset_index.DatasetIndex.image_ids)
+    """
+    return dataset_index.open_index(root_dir).image_ids(pattern=pattern, id_range=id_range)
+
+
+def add_store_argument(parser):
+    """ Adds the option that enables the persistent prediction store to a script's parser """
+    help_st = "Directory of the persistent prediction store. Predictions are read from and saved to it when given"
+    parser.add_argument("-st", "--store_dir", help=help_st, type=str, default=None, required=False)
+
+
+def enable_prediction_store(store_dir):
+    """ Enables the prediction store in this process and the worker processes it starts """
+    if store_dir is not None:
+        os.environ[STORE_ENV_VAR] = store_dir
+
+
+def add_trace_argument(parser):
+    """ Adds the option that enables the instrumentation to a script's parser """
+    help_tr = "Trace file of the stage timings: a Chrome trace (.json), or a structured log with one JSON event per " \
+              "line (.jsonl). The pipeline is not instrumented when it is not given"
+    parser.add_argument("-tr", "--trace_file", help=help_tr, type=str, default=None, required=False)
+
+
+def enable_tracing(trace_file):
+    """ Enables the instrumentation in this process and the worker processes it starts """
+    if trace_file is not None:
+        os.environ[TRACE_ENV_VAR] = trace_file
+        # instrumentation uses this module, so it is only imported when tracing is enabled
+        import instrumentation
+        instrumentation.enable(trace_file)
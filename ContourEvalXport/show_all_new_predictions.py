@@ -1,5 +1,13 @@
+import io
 import os
 import argparse
+import matplotlib
+# Render without a display; must be selected before pyplot is imported
+matplotlib.use("Agg")
+import artifact_cache
+import dataset_index
+import instrumentation
+import pipeline
 import show_new_prediction as show
 import shared_resources as shres
 
@@ -23,26 +31,78 @@ def parse_arguments():
     help_c = "Enter 0 to use edge connectivity, 1 to use vertex connectivity"
     required.add_argument("-c", "--connectivity", help=help_c, type=int, required=False, default=0)
 
-    args= parser.parse_args()
+    help_w = "number of worker processes rendering images. Default is the number of CPUs"
+    parser.add_argument("-w", "--workers", help=help_w, type=int, required=False, default=os.cpu_count())
+
+    help_m = "'figure' saves the titled matplotlib figure; 'composite' saves the panels side by side, colour-mapped " \
+             "with NumPy, which is several times faster"
+    parser.add_argument("-m", "--mode", help=help_m, type=str, required=False, default="figure",
+                        choices=list(RENDERERS.keys()))
+
+    pipeline.add_pipeline_arguments(parser)
+    dataset_index.add_selection_arguments(parser)
+    shres.add_store_argument(parser)
+    shres.add_trace_argument(parser)
+    args = parser.parse_args()
+    shres.enable_prediction_store(args.store_dir)
+    shres.enable_tracing(args.trace_file)
 
     return {"root_dir": args.root_dir,
             "output_dir": args.output_dir,
             "border": args.border,
             "connectivity": args.connectivity,
-            "predictor": args.predictor}
+            "predictor": args.predictor,
+            "ids": args.ids,
+            "id_range": args.id_range,
+            "workers": args.workers,
+            "mode": args.mode,
+            "queue_size": args.queue_size,
+            "io_threads": args.io_threads}
 
-def show_all_predictions(user_options):
-    class_dir_path = os.path.join(user_options["root_dir"], 'Classes')
-    if not os.path.isdir(user_options["output_dir"]):
-        os.makedirs(user_options["output_dir"])
-    for image in os.listdir(class_dir_path):
-        id = image[:3]
+# Ways of saving the panels of one image
+RENDERERS = {"figure": show.show_all_images,
+             "composite": show.save_composite}
+
+def prefetch_job(job):
+    """ Reads the files of one image ahead of its rendering. Runs in the I/O threads """
+    user_options, id = job
+    index = dataset_index.open_index(user_options["root_dir"])
+    return job, pipeline.read_files([index.file(id, kind) for kind in dataset_index.KINDS])
+
+def render_job(prefetched_job):
+    """ Renders the predictions of one image to png data, decoding its files from memory. Runs in the worker
+    processes
+    """
+    (user_options, id), contents = prefetched_job
+    with instrumentation.image(id), artifact_cache.prefetched(contents):
         resources = shres.Resources(root_dir=user_options["root_dir"], image_index=id,
                                     predictor_name=user_options["predictor"],
                                     borders=user_options["border"],
                                     connectivity=user_options["connectivity"])
-        output_path = os.path.join(user_options["output_dir"], image)
-        show.show_all_images(resources, output_path)
+        output = io.BytesIO()
+        RENDERERS[user_options.get("mode", "figure")](resources, output)
+    return os.path.join(user_options["output_dir"], resources.image_name), output.getvalue()
+
+def write_output(rendered):
+    """ Saves the png data of one image. Runs in the I/O thread """
+    output_path, data = rendered
+    with open(output_path, "wb") as f:
+        f.write(data)
+    return output_path
+
+def show_all_predictions(user_options):
+    """ Renders every selected image across 'workers' processes, while the next images are read and the rendered
+    ones written. Returns the paths of the saved images
+    """
+    if not os.path.isdir(user_options["output_dir"]):
+        os.makedirs(user_options["output_dir"])
+    jobs = ((user_options, id) for id in shres.list_image_ids(user_options["root_dir"],
+                                                              pattern=user_options.get("ids"),
+                                                              id_range=user_options.get("id_range")))
+    stages = [pipeline.Stage("read", prefetch_job, "thread", user_options.get("io_threads", 4)),
+              pipeline.Stage("render", render_job, "process", user_options.get("workers") or 1),
+              pipeline.Stage("write", write_output, "thread", 1)]
+    return pipeline.run_pipeline(jobs, stages, queue_size=user_options.get("queue_size", 4))
 
 if __name__ == '__main__':
     show_all_predictions(parse_arguments())
@@ -2,65 +2,100 @@
 program evaluates performance for a particular target image. """
 
 import numpy as np
-import skimage.io
-import skimage.morphology
+import scipy.sparse
+import skimage.measure
 import skimage.segmentation
-from prettytable import PrettyTable
 
+import artifact_cache
+import instrumentation
 import shared_resources as shres
 import predictors as pred
 
+# IoU thresholds of the object scores
+F1_THRESHOLDS = np.arange(0.5, 0.95, 0.05)
+
 
 def evaluate_jaccard_score(resources):
-    ground_truth_path = resources.annot_file
-    ground_truth = skimage.io.imread(ground_truth_path)
+    with instrumentation.image(resources.index):
+        ground_truth = load_ground_truth(resources.annot_file)
+        prediction = pred.Predictor(resources).predict()
+
+        jaccard = jaccard_index(ground_truth, prediction)
+
+    print("-------------------------------------------------------")
+    print("Jaccard index: {}".format(round(jaccard, 4)))
+    print("-------------------------------------------------------")
+
+    return jaccard
+
+
+def load_ground_truth(ground_truth_path):
+    """ Reads an annotation image and returns its sequentially labelled objects. The result is cached """
+    return artifact_cache.CACHE.get(artifact_cache.file_key("ground_truth", ground_truth_path),
+                                    lambda: label_ground_truth(artifact_cache.read_image(ground_truth_path)))
 
+
+def label_ground_truth(ground_truth):
+    """ Labels the objects of an annotation image sequentially """
     if len(ground_truth.shape) == 3:
         ground_truth = ground_truth[:, :, 0]
 
-    ground_truth = skimage.morphology.label(ground_truth)
-    prediction = pred.Predictor(resources).predict()
+    with instrumentation.stage("label ground truth"):
+        ground_truth = skimage.measure.label(ground_truth)
+        return pred.compact_labels(skimage.segmentation.relabel_sequential(ground_truth)[0])
+
+
+def jaccard_index(ground_truth, prediction):
+    """ Mean over the predicted objects of their best IoU with a ground truth object. 'ground_truth' must be
+    sequentially labelled (see load_ground_truth)
+    """
+    with instrumentation.stage("relabel"):
+        prediction = skimage.segmentation.relabel_sequential(prediction)[0]
 
-    ground_truth = skimage.segmentation.relabel_sequential(ground_truth)[0]
-    prediction = skimage.segmentation.relabel_sequential(prediction)[0]
+    return mean_best_iou(sparse_intersection_over_union(ground_truth, prediction))
 
-    iou_array = intersection_over_union(ground_truth, prediction)
 
+def mean_best_iou(iou_array):
+    """ Jaccard index of a (sparse) IoU matrix, see jaccard_index """
     if iou_array.shape[0] > 0:
-        jaccard = np.amax(iou_array, axis=0).mean()
+        # Best IoU of each predicted object; objects that overlap no ground truth object score 0
+        best_iou = np.zeros(iou_array.shape[1])
+        np.maximum.at(best_iou, iou_array.col, iou_array.data)
+        jaccard = best_iou.mean()
     else:
         jaccard = 0.0
-
-    print("-------------------------------------------------------")
-    print("Jaccard index: {}".format(round(jaccard, 4)))
-    print("-------------------------------------------------------")
-
     return jaccard
 
 
-def evaluate_object_scores(resources):
-    ground_truth_path = resources.annot_file
-    ground_truth = skimage.io.imread(ground_truth_path)
+def object_scores(ground_truth, prediction, thresholds):
+    """ Jaccard index and F1 scores at 'thresholds' of a prediction, from a single IoU matrix. 'ground_truth' must be
+    sequentially labelled (see load_ground_truth)
+    """
+    with instrumentation.stage("relabel"):
+        prediction = skimage.segmentation.relabel_sequential(prediction)[0]
+
+    iou_array = sparse_intersection_over_union(ground_truth, prediction)
+    return mean_best_iou(iou_array), measures_at_thresholds(thresholds, iou_array)["f1"]
 
-    if len(ground_truth.shape) == 3:
-        ground_truth = ground_truth[:, :, 0]
 
-    ground_truth = skimage.morphology.label(ground_truth)
+def evaluate_object_scores(resources):
+    ground_truth = load_ground_truth(resources.annot_file)
     prediction = pred.Predictor(resources).predict()
 
-    ground_truth = skimage.segmentation.relabel_sequential(ground_truth)[0]
-    prediction = skimage.segmentation.relabel_sequential(prediction)[0]
+    with instrumentation.stage("relabel"):
+        prediction = skimage.segmentation.relabel_sequential(prediction)[0]
 
-    iou_array = intersection_over_union(ground_truth, prediction)
+    iou_array = sparse_intersection_over_union(ground_truth, prediction)
 
     # Compute scores at different thresholds
+    measures = measures_at_thresholds(F1_THRESHOLDS, iou_array)
     scores = []
-    for t in np.arange(0.5, 0.95, 0.05):
-        f1, tp, fp, fn = measures_at(t, iou_array)
+    for t, f1, tp, fp, fn in zip(measures["threshold"], measures["f1"], measures["tp"], measures["fp"], measures["fn"]):
         res = {"threshold": t, "f1": f1, "tp": tp, "fp": fp, "fn": fn}
         scores.append(res)
 
     # Create a display table
+    from prettytable import PrettyTable
     table = PrettyTable()
     table.field_names = ["Thres", "F1", "TP", "FP", "FN"]
     for score in scores:
@@ -70,6 +105,7 @@ def evaluate_object_scores(resources):
     return scores
 
 
+@instrumentation.timed("iou")
 def intersection_over_union(ground_truth, prediction):
     """ Computes the IoU metric given two images; the ground truth and the predicted image.
     Returns: A numpy array of size MxN where M is the number of nuclei in the ground truth and N the number
@@ -81,7 +117,7 @@ def intersection_over_union(ground_truth, prediction):
     pred_objects = len(np.unique(prediction))
 
     # Compute intersection
-    h = np.histogram2d(ground_truth.flatten(), prediction.flatten(), bins=(true_objects, pred_objects))
+    h = np.histogram2d(ground_truth.ravel(), prediction.ravel(), bins=(true_objects, pred_objects))
     intersection = h[0]
 
     # Area of objects
@@ -104,12 +140,61 @@ def intersection_over_union(ground_truth, prediction):
     return iou_array
 
 
+@instrumentation.timed("iou")
+def sparse_intersection_over_union(ground_truth, prediction):
+    """ Computes the same IoU values as intersection_over_union, with integer counts, and keeps them sparse.
+    Both images must be sequentially labelled.
+    Returns: A scipy.sparse.coo_matrix of size MxN that stores only the pairs of objects that overlap, so memory
+    scales with the number of overlapping pairs instead of MxN.
+    """
+    true_objects = int(ground_truth.max()) + 1
+    pred_objects = int(prediction.max()) + 1
+    ground_truth = ground_truth.ravel()
+    prediction = prediction.ravel()
+
+    # Each pixel is mapped to the index of its (ground truth, prediction) label pair. The products are computed in
+    # place, so only one 64-bit array of the image size is allocated
+    pairs = ground_truth.astype(np.int64)
+    pairs *= pred_objects
+    pairs += prediction
+    if true_objects * pred_objects <= pairs.size:
+        # A count per possible pair costs no more memory than the image itself
+        counts = np.bincount(pairs, minlength=true_objects * pred_objects)
+        del pairs
+        pairs = np.flatnonzero(counts)
+        intersection = counts[pairs]
+    else:
+        pairs, intersection = np.unique(pairs, return_counts=True)
+    rows, cols = np.divmod(pairs, pred_objects)
+
+    # Area of objects. Every pixel belongs to one pair, so the areas are sums of the pair counts
+    area_true = np.bincount(rows, weights=intersection, minlength=true_objects).astype(np.int64)
+    area_pred = np.bincount(cols, weights=intersection, minlength=pred_objects).astype(np.int64)
+
+    # Exclude background from the analysis
+    objects = (rows > 0) & (cols > 0)
+    rows, cols, intersection = rows[objects], cols[objects], intersection[objects]
+
+    union = area_true[rows] + area_pred[cols] - intersection
+    iou = intersection / union
+    return scipy.sparse.coo_matrix((iou, (rows - 1, cols - 1)), shape=(true_objects - 1, pred_objects - 1))
+
+
 def measures_at(threshold, iou_array):
-    matches = iou_array > threshold
+    """ Object scores at 'threshold' for a dense IoU array or a sparse matrix from sparse_intersection_over_union """
+    if scipy.sparse.issparse(iou_array):
+        iou_array = iou_array.tocoo()
+        matches = iou_array.data > threshold
+        matches_per_true = np.bincount(iou_array.row[matches], minlength=iou_array.shape[0])
+        matches_per_pred = np.bincount(iou_array.col[matches], minlength=iou_array.shape[1])
+    else:
+        matches = iou_array > threshold
+        matches_per_true = np.sum(matches, axis=1)
+        matches_per_pred = np.sum(matches, axis=0)
 
-    true_positives = np.sum(matches, axis=1) == 1  # Correct objects
-    false_positives = np.sum(matches, axis=0) == 0  # Extra objects
-    false_negatives = np.sum(matches, axis=1) == 0  # Missed objects
+    true_positives = matches_per_true == 1  # Correct objects
+    false_positives = matches_per_pred == 0  # Extra objects
+    false_negatives = matches_per_true == 0  # Missed objects
 
     assert np.all(np.less_equal(true_positives, 1))
     assert np.all(np.less_equal(false_positives, 1))
@@ -122,6 +207,64 @@ def measures_at(threshold, iou_array):
     return f1, true_pos, false_pos, false_neg
 
 
+@instrumentation.timed("measures")
+def measures_at_thresholds(thresholds, iou_arrays):
+    """ Computes the scores of measures_at for any number of thresholds (between 0 and 1) in one sweep.
+    'iou_arrays' is an IoU array (dense or sparse) or a list of them for a batch of images.
+    Returns: A dictionary with the thresholds and the 'f1', 'tp', 'fp' and 'fn' arrays. Their shape is
+    (thresholds,) for a single IoU array and (images, thresholds) for a list; sum 'tp', 'fp' and 'fn' over the first
+    axis for dataset totals.
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    batch = isinstance(iou_arrays, (list, tuple))
+    if not batch:
+        iou_arrays = [iou_arrays]
+
+    tp = np.zeros((len(iou_arrays), len(thresholds)), dtype=np.int64)
+    fp = np.zeros_like(tp)
+    fn = np.zeros_like(tp)
+    for index, iou_array in enumerate(iou_arrays):
+        best_true, second_true, best_pred = best_matches(iou_array)
+
+        # A ground truth object is matched once when its best IoU is above the threshold and its second best is not.
+        # Sorting the values once answers every threshold with a binary search
+        best_true.sort()
+        second_true.sort()
+        best_pred.sort()
+        missed = np.searchsorted(best_true, thresholds, side='right')
+        matched_twice = len(second_true) - np.searchsorted(second_true, thresholds, side='right')
+        tp[index] = len(best_true) - missed - matched_twice
+        fn[index] = missed
+        fp[index] = np.searchsorted(best_pred, thresholds, side='right')
+
+    f1 = 2 * tp / (2 * tp + fp + fn + 1e-9)
+    if not batch:
+        tp, fp, fn, f1 = tp[0], fp[0], fn[0], f1[0]
+    return {"threshold": thresholds, "f1": f1, "tp": tp, "fp": fp, "fn": fn}
+
+
+def best_matches(iou_array):
+    """ Returns the best and second best IoU of every ground truth object and the best IoU of every predicted object
+    (0 when there is no overlap)
+    """
+    iou_array = scipy.sparse.coo_matrix(iou_array)
+    best_true = np.zeros(iou_array.shape[0])
+    second_true = np.zeros(iou_array.shape[0])
+    best_pred = np.zeros(iou_array.shape[1])
+    np.maximum.at(best_pred, iou_array.col, iou_array.data)
+
+    # Sort the entries by object and decreasing IoU; the first entry of each object is its best, the next its second
+    order = np.lexsort((-iou_array.data, iou_array.row))
+    rows, values = iou_array.row[order], iou_array.data[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    best_true[rows[first]] = values[first]
+    second = np.zeros(len(rows), dtype=bool)
+    second[1:] = first[:-1] & ~first[1:]
+    second_true[rows[second]] = values[second]
+    return best_true, second_true, best_pred
+
+
 if __name__ == "__main__":
     RESOURCES = shres.parse_arguments()
 
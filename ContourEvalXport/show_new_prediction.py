@@ -2,23 +2,40 @@
  or border. Compares the interior estimates with the annotations"""
 
 import sys
-import skimage.io
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
+import PIL.Image
 
+import artifact_cache
 import shared_resources as shres
 import predictors as pred
 
 
-def show_all_images(resources_new, out_path):
-    resources_baseline = shres.Resources(root_dir=resources_new.root_dir, image_index=resources_new.index)
-    class_img = skimage.io.imread(resources_new.class_file)
-    annot_img = skimage.io.imread(resources_new.annot_file)
-    raw_img = skimage.io.imread(resources_new.image_file)
+def review_panels(resources_new):
+    """ Returns the 12 (title, image, colour map) panels that compare the new predictor with the baseline on one
+    image. The two predictors share the decoding and cleanup of the class image
+    """
+    class_img = artifact_cache.read_image(resources_new.class_file)
+    annot_img = artifact_cache.read_image(resources_new.annot_file)
+    raw_img = artifact_cache.read_image(resources_new.image_file)
+
+    if len(class_img.shape) != 3:
+        print("Images representing classes must have 3 channels")
+        print("The selected class image has {} channels".format(len(class_img.shape)))
+        sys.exit(1)
+
+    if len(annot_img.shape) != 2:
+        print("Images representing annotations must have 1 color channel (i.e. gray-scale")
+        print("The selected annotation image has {} channels".format(len(annot_img.shape)))
+        sys.exit(1)
 
     binary_annot = np.where(annot_img > 0, 1, 0)
 
-    pred_labels_new = pred.Predictor(resources_new).predict()
+    baseline_settings = shres.PredictorSettings(predictor='baseline')
+    predictions = pred.Predictor(resources_new).predict_many([resources_new.settings, baseline_settings])
+    pred_labels_new = predictions[resources_new.settings]
+    pred_labels_baseline = predictions[baseline_settings]
 
     bin_pred_labels_new = np.where(pred_labels_new > 0, 1, 0)
 
@@ -27,23 +44,12 @@ def show_all_images(resources_new, out_path):
     error_data_new = np.where(error_data_new > 0, 1, error_data_new)
     error_data_new = np.where(error_data_new < 0, -1, error_data_new)
 
-    pred_labels_baseline = pred.Predictor(resources_baseline).predict()
     bin_pred_labels_baseline = np.where(pred_labels_baseline > 0, 1, 0)
 
     error_data_baseline = binary_annot - bin_pred_labels_baseline
     error_data_baseline = np.where(error_data_baseline > 0, 1, error_data_baseline)
     error_data_baseline = np.where(error_data_baseline < 0, -1, error_data_baseline)
 
-    if len(class_img.shape) != 3:
-        print("Images representing classes must have 3 channels")
-        print("The selected class image has {} channels".format(len(class_img.shape)))
-        sys.exit(1)
-
-    if len(annot_img.shape) != 2:
-        print("Images representing annotations must have 1 color channel (i.e. gray-scale")
-        print("The selected annotation image has {} channels".format(len(annot_img.shape)))
-        sys.exit(1)
-
     background_img = class_img[:, :, 0]
     interior_img = class_img[:, :, 1]
     border_img = class_img[:, :, 2]
@@ -52,70 +58,63 @@ def show_all_images(resources_new, out_path):
     # show_stats(interior_img, "interior class:")
     # show_stats(border_img, "border class: ")
 
+    return [("original img", raw_img, None), ("annotations", annot_img, None), ("annot mask", binary_annot, None),
+            ("background", background_img, 'bone'), ("interior", interior_img, 'bone'),
+            ("border", border_img, 'bone'),
+            ("pred baseline labels", pred_labels_baseline, None),
+            ("pred baseline mask", bin_pred_labels_baseline, None),
+            ("baseline errors", error_data_baseline, 'jet'),
+            ("pred new labels", pred_labels_new, None), ("pred new mask", bin_pred_labels_new, None),
+            ("new errors", error_data_new, 'jet')]
+
+
+def show_all_images(resources_new, out_path):
+    """ Saves the review figure of one image as a png to 'out_path' (a path or a binary file). The figure is closed
+    afterwards, so rendering many images does not accumulate figures
+    """
     fig = plt.figure(constrained_layout=True)
     gs = fig.add_gridspec(12, 9)
 
-    a11 = fig.add_subplot(gs[:3, :3])
-    plt.imshow(raw_img)
-    a11.set_title("original img")
-    plt.axis("off")
-
-    a12 = fig.add_subplot(gs[:3, 3:6])
-    plt.imshow(annot_img)
-    a12.set_title("annotations")
-    plt.axis("off")
-
-    a13 = fig.add_subplot(gs[:3, 6:9])
-    plt.imshow(binary_annot)
-    a13.set_title("annot mask")
-    plt.axis("off")
-
-    a21 = fig.add_subplot(gs[3:6, :3])
-    plt.imshow(background_img, cmap='bone')
-    a21.set_title("background")
-    plt.axis("off")
-
-    a22 = fig.add_subplot(gs[3:6, 3:6])
-    plt.imshow(interior_img, cmap='bone')
-    a22.set_title("interior")
-    plt.axis("off")
-
-    a23 = fig.add_subplot(gs[3:6, 6:9])
-    plt.imshow(border_img, cmap='bone')
-    a23.set_title("border")
-    plt.axis("off")
-
-    a31 = fig.add_subplot(gs[6:9, :3])
-    plt.imshow(pred_labels_baseline)
-    a31.set_title("pred baseline labels")
-    plt.axis("off")
-
-    a32 = fig.add_subplot(gs[6:9, 3:6])
-    plt.imshow(bin_pred_labels_baseline)
-    a32.set_title("pred baseline mask")
-    plt.axis("off")
-
-    a33 = fig.add_subplot(gs[6:9, 6:9])
-    plt.imshow(error_data_baseline, cmap='jet')
-    a33.set_title("baseline errors")
-    plt.axis("off")
-
-    a41 = fig.add_subplot(gs[9:12, :3])
-    plt.imshow(pred_labels_new)
-    a41.set_title("pred new labels")
-    plt.axis("off")
-
-    a42 = fig.add_subplot(gs[9:12, 3:6])
-    plt.imshow(bin_pred_labels_new)
-    a42.set_title("pred new mask")
-    plt.axis("off")
-
-    a43 = fig.add_subplot(gs[9:12, 6:9])
-    plt.imshow(error_data_new, cmap='jet')
-    a43.set_title("new errors")
-    plt.axis("off")
-
-    plt.savefig(out_path)
+    for position, (title, image, cmap) in enumerate(review_panels(resources_new)):
+        row, col = divmod(position, 3)
+        axes = fig.add_subplot(gs[3 * row:3 * row + 3, 3 * col:3 * col + 3])
+        plt.imshow(image, cmap=cmap)
+        axes.set_title(title)
+        plt.axis("off")
+
+    plt.savefig(out_path, format="png")
+    plt.close(fig)
+
+
+def save_composite(resources_new, out_path, gap=4):
+    """ Lightweight alternative to show_all_images: colour-maps the 12 panels with NumPy (the same colour maps as
+    the figure, without titles) and saves them as one png in a 4 x 3 grid to 'out_path' (a path or a binary file)
+    """
+    panels = [colour_map(image, cmap) for _, image, cmap in review_panels(resources_new)]
+    height, width = panels[0].shape[:2]
+    composite = np.full((4 * height + 3 * gap, 3 * width + 2 * gap, 3), 255, dtype=np.uint8)
+    for position, panel in enumerate(panels):
+        row, col = divmod(position, 3)
+        top, left = row * (height + gap), col * (width + gap)
+        composite[top:top + height, left:left + width] = panel[:height, :width]
+    PIL.Image.fromarray(composite).save(out_path, format="png")
+
+
+def colour_map(image, cmap=None):
+    """ RGB uint8 version of 'image' as plt.imshow shows it: colour images are kept, other images are scaled
+    between their minimum and maximum and mapped through 'cmap' (viridis by default)
+    """
+    if image.ndim == 3:
+        return np.ascontiguousarray(image[:, :, :3]).astype(np.uint8, copy=False)
+    lookup = colour_lookup_table(cmap or 'viridis')
+    low, high = image.min(), image.max()
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return lookup[((image - low) * scale).astype(np.uint8)]
+
+
+def colour_lookup_table(cmap):
+    """ 256 x 3 uint8 table of the matplotlib colour map 'cmap' """
+    return (matplotlib.colormaps[cmap](np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
 
 
 def show_stats(img_array, name=""):
@@ -3,8 +3,8 @@ displays the masks as overlays on top of raw images (i.e. tissue images).
 """
 
 import numpy as np
-import skimage.io
 import matplotlib.pyplot as plt
+import artifact_cache
 import shared_resources as shres
 import predictors as pred
 
@@ -12,8 +12,8 @@ import predictors as pred
 def show_overlays(resources):
 
     # Read target images (raw image and its class image)
-    raw_img = skimage.io.imread(resources.image_file)
-    class_img = skimage.io.imread(resources.class_file)
+    raw_img = artifact_cache.read_image(resources.image_file)
+    class_img = artifact_cache.read_image(resources.class_file)
 
     pred_labels = pred.Predictor(resources).predict()
 
@@ -2,18 +2,18 @@
  or border. Compares the interior estimates with the annotations"""
 
 import sys
-import skimage.io
 import numpy as np
 import matplotlib.pyplot as plt
 
+import artifact_cache
 import shared_resources as shres
 import predictors as pred
 
 
 def show_all_images(resources):
-    class_img = skimage.io.imread(resources.class_file)
-    annot_img = skimage.io.imread(resources.annot_file)
-    raw_img = skimage.io.imread(resources.image_file)
+    class_img = artifact_cache.read_image(resources.class_file)
+    annot_img = artifact_cache.read_image(resources.annot_file)
+    raw_img = artifact_cache.read_image(resources.image_file)
 
     binary_annot = np.where(annot_img > 0, 1, 0)
 
@@ -0,0 +1,10 @@
+""" The modules of the package are flat scripts that import each other by name, so the tests import them the same
+way. SMALL_EVAL is the sample dataset shipped with them
+"""
+
+import os
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SMALL_EVAL = os.path.join(PACKAGE_DIR, "SmallEval")
+sys.path.insert(0, PACKAGE_DIR)
@@ -0,0 +1,145 @@
+""" The optimised code paths against the implementations they replaced, on the images of SmallEval """
+
+import numpy as np
+import pytest
+import skimage.morphology
+import skimage.segmentation
+
+import artifact_cache
+import predictors as pred
+import propagation
+import shared_resources as shres
+import show_eval as eval
+from conftest import SMALL_EVAL
+
+IMAGE_IDS = shres.list_image_ids(SMALL_EVAL)
+# The python engine visits every pixel on every pass, so it only runs on a few images
+PYTHON_IMAGE_IDS = IMAGE_IDS[::5]
+FAST_ENGINES = ["numpy", "frontier", "numba"]
+
+
+def class_image(image_id):
+    return artifact_cache.read_image(shres.Resources(SMALL_EVAL, image_index=image_id).class_file)
+
+
+def ground_truth(image_id):
+    return eval.load_ground_truth(shres.Resources(SMALL_EVAL, image_index=image_id).annot_file)
+
+
+def passes_of(engine, interior, boundary, borders=0, seed=None):
+    """ Copy of the label image after every pass of an engine. Without numba, the numba engine would run the
+    frontier engine, so its tests are skipped
+    """
+    if engine == "numba" and not propagation.HAVE_NUMBA:
+        pytest.skip("numba is not installed")
+    return [final.copy() for final in propagation.ENGINES[engine](interior, boundary, borders=borders, seed=seed)]
+
+
+def skimage_interior_and_boundary(class_image, cell_min_size=shres.DEFAULT_CELL_MIN_SIZE):
+    """ Front end of the predictors before the cleanup and labelling moved to scipy.ndimage """
+    argmax = pred.class_argmax(class_image)
+    cell = skimage.morphology.remove_small_holes(argmax == 1, max_size=cell_min_size)
+    cell = skimage.morphology.remove_small_objects(cell, max_size=cell_min_size)
+    interior, num_labels = skimage.morphology.label(cell, return_num=True, background=0)
+    interior = pred.compact_labels(interior, num_labels + 1)
+    np.add(interior, 1, out=interior, where=interior != 0)
+    return interior, argmax == 2
+
+
+@pytest.fixture(scope="module", params=IMAGE_IDS)
+def image_id(request):
+    return request.param
+
+
+@pytest.mark.parametrize("cell_min_size", [0, shres.DEFAULT_CELL_MIN_SIZE, 100])
+def test_scipy_cleanup_matches_skimage(image_id, cell_min_size):
+    interior, boundary = pred.interior_and_boundary(class_image(image_id), cell_min_size)
+    expected_interior, expected_boundary = skimage_interior_and_boundary(class_image(image_id), cell_min_size)
+    assert interior.dtype == expected_interior.dtype
+    assert np.array_equal(interior, expected_interior)
+    assert np.array_equal(boundary, expected_boundary)
+
+
+@pytest.mark.parametrize("engine", FAST_ENGINES)
+@pytest.mark.parametrize("image_id", PYTHON_IMAGE_IDS)
+def test_engines_match_python_engine(image_id, engine):
+    interior, boundary = pred.interior_and_boundary(class_image(image_id))
+    expected = passes_of("python", interior, boundary)
+    passes = passes_of(engine, interior, boundary)
+    assert len(passes) == len(expected)
+    for final, expected_final in zip(passes, expected):
+        assert np.array_equal(final, expected_final)
+
+
+@pytest.mark.parametrize("engine", FAST_ENGINES)
+@pytest.mark.parametrize("image_id", PYTHON_IMAGE_IDS)
+def test_engines_label_the_pixels_of_python_engine_when_joining_borders(image_id, engine):
+    # The engines draw their random choices differently, but which pixels get a label does not depend on them
+    interior, boundary = pred.interior_and_boundary(class_image(image_id))
+    expected = passes_of("python", interior, boundary, borders=1, seed=0)
+    passes = passes_of(engine, interior, boundary, borders=1, seed=0)
+    assert len(passes) == len(expected)
+    for final, expected_final in zip(passes, expected):
+        assert np.array_equal(final > 0, expected_final > 0)
+
+
+@pytest.mark.parametrize("engine", ["numpy", "numba"])
+def test_engines_match_frontier_with_a_seed(image_id, engine):
+    interior, boundary = pred.interior_and_boundary(class_image(image_id))
+    expected = passes_of("frontier", interior, boundary, borders=1, seed=7)
+    passes = passes_of(engine, interior, boundary, borders=1, seed=7)
+    assert len(passes) == len(expected)
+    for final, expected_final in zip(passes, expected):
+        assert np.array_equal(final, expected_final)
+
+
+def test_frontier_is_repeatable_with_a_seed(image_id):
+    interior, boundary = pred.interior_and_boundary(class_image(image_id))
+    first = propagation.propagate(interior, boundary, borders=1, engine="frontier", seed=3)
+    second = propagation.propagate(interior, boundary, borders=1, engine="frontier", seed=3)
+    assert np.array_equal(first, second)
+
+
+@pytest.mark.parametrize("predictor", ["baseline", "pixel", "watershed", "distance"])
+def test_sparse_iou_matches_dense_iou(image_id, predictor):
+    truth = ground_truth(image_id)
+    prediction = pred.Predictor(shres.PredictorSettings(predictor=predictor)).predict(class_image(image_id))
+    prediction = skimage.segmentation.relabel_sequential(prediction)[0]
+    sparse = eval.sparse_intersection_over_union(truth, prediction)
+    dense = eval.intersection_over_union(truth, prediction)
+    assert sparse.shape == dense.shape
+    np.testing.assert_allclose(sparse.toarray(), dense, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("predictor", ["baseline", "pixel", "watershed", "distance"])
+def test_measures_at_thresholds_match_measures_at(image_id, predictor):
+    truth = ground_truth(image_id)
+    prediction = pred.Predictor(shres.PredictorSettings(predictor=predictor)).predict(class_image(image_id))
+    prediction = skimage.segmentation.relabel_sequential(prediction)[0]
+    iou_array = eval.sparse_intersection_over_union(truth, prediction)
+    measures = eval.measures_at_thresholds(eval.F1_THRESHOLDS, iou_array)
+    for index, threshold in enumerate(eval.F1_THRESHOLDS):
+        for iou in (iou_array, eval.intersection_over_union(truth, prediction)):
+            f1, tp, fp, fn = eval.measures_at(threshold, iou)
+            assert (tp, fp, fn) == (measures["tp"][index], measures["fp"][index], measures["fn"][index])
+            assert f1 == pytest.approx(measures["f1"][index])
+
+
+def test_predict_many_matches_predict(monkeypatch):
+    image = class_image(IMAGE_IDS[0])
+    configurations = [shres.PredictorSettings(predictor=predictor, borders=borders, connectivity=connectivity,
+                                              passes=passes, seed=1, cell_min_size=cell_min_size)
+                      for predictor in ["baseline", "pixel", "watershed", "distance", "euclidean"]
+                      for borders in (0, 1) for connectivity in (0, 1) for passes in (2, None)
+                      for cell_min_size in (10, 25)]
+    expected = {settings: pred.Predictor(settings).predict(image) for settings in configurations}
+
+    front_ends = []
+    interior_and_boundary = pred.interior_and_boundary
+    monkeypatch.setattr(pred, "interior_and_boundary",
+                        lambda *args: front_ends.append(args[1:]) or interior_and_boundary(*args))
+    predictions = pred.Predictor(configurations[0]).predict_many(configurations, image)
+    # Every predictor starts from the front end computed once per cell_min_size
+    assert sorted(front_ends) == [(10,), (25,)]
+    for settings in configurations:
+        assert np.array_equal(predictions[settings], expected[settings])
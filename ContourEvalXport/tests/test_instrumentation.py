@@ -0,0 +1,39 @@
+""" Events recorded by the instrumentation of the batch drivers """
+
+import json
+import os
+
+import pytest
+
+import evaluate_new_method
+import instrumentation
+import shared_resources as shres
+from conftest import SMALL_EVAL
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "trace.jsonl")
+    monkeypatch.delenv(shres.TRACE_ENV_VAR, raising=False)
+    shres.enable_tracing(path)
+    yield path
+    instrumentation.disable()
+    os.environ.pop(shres.TRACE_ENV_VAR, None)
+
+
+def test_evaluate_passes_traces_the_propagation(tmp_path, trace_file):
+    image_ids = shres.list_image_ids(SMALL_EVAL)[:2]
+    evaluate_new_method.evaluate_passes({"root_dir": SMALL_EVAL, "output_file": str(tmp_path / "passes.txt"),
+                                         "workers": 1, "seed": 0, "max_passes": 3,
+                                         "id_range": (image_ids[0], image_ids[-1])})
+    instrumentation.flush()
+    with open(trace_file) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+
+    stages = [event for event in events if event["ph"] == "X" and event["name"] == "propagate"]
+    passes = [event["args"]["passes"] for event in events if event["ph"] == "C" and event["name"] == "passes"]
+    images = [event for event in events if event["ph"] == "X" and event["name"] == "image"]
+    assert len(images) == 2
+    assert stages
+    assert passes and max(passes) == 3
+    assert all("propagate (ms)" in image["args"] for image in images)
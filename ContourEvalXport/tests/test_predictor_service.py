@@ -0,0 +1,50 @@
+""" Predictor service against direct predictions """
+
+import os
+import signal
+import time
+
+import numpy as np
+import pytest
+
+import predictor_service
+import predictors as pred
+import shared_resources as shres
+from conftest import SMALL_EVAL
+
+SETTINGS = shres.PredictorSettings(predictor="pixel")
+
+
+@pytest.fixture
+def service():
+    service = predictor_service.PredictorService(workers=1, request_timeout=60)
+    yield service
+    service.close()
+
+
+@pytest.fixture
+def class_file():
+    return shres.Resources(SMALL_EVAL, image_index=shres.list_image_ids(SMALL_EVAL)[0]).class_file
+
+
+def test_predict_matches_predictor(service, class_file):
+    assert np.array_equal(service.predict(class_file, SETTINGS), pred.Predictor(SETTINGS).predict(class_file))
+
+
+def test_request_after_a_worker_died_succeeds(service, class_file):
+    expected = pred.Predictor(SETTINGS).predict(class_file)
+    assert np.array_equal(service.predict(class_file, SETTINGS), expected)
+
+    executor = service.executor
+    for pid in list(executor._processes):
+        os.kill(pid, signal.SIGKILL)
+    # Wait until the pool notices the death, as it would between two requests
+    deadline = time.monotonic() + 10
+    while not executor._broken and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert np.array_equal(service.predict(class_file, SETTINGS), expected)
+    assert np.array_equal(service.predict(class_file, SETTINGS), expected)
+    assert service.stats()["errors"] == 0
+    assert service.stats()["worker restarts"] == 1
+    assert service.batcher.is_alive()
@@ -0,0 +1,39 @@
+""" Tiled predictions against the prediction of the whole class map """
+
+import numpy as np
+import pytest
+
+import benchmark
+import predictors as pred
+import shared_resources as shres
+import tiling
+
+
+def same_objects(first, second):
+    """ Whether two label images have the same objects, whatever their label numbers """
+    labelled = (first > 0) | (second > 0)
+    pairs = np.unique(np.stack([first[labelled], second[labelled]]), axis=1)
+    return len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+@pytest.mark.parametrize("predictor", ["baseline", "pixel", "distance", "euclidean"])
+@pytest.mark.parametrize("tile_size, halo", [(200, 32), (256, 64)])
+def test_tiled_equals_untiled(tmp_path, predictor, tile_size, halo):
+    class_image = benchmark.synthetic_class_image(1024, 1024, seed=0)
+    settings = shres.PredictorSettings(predictor=predictor)
+    untiled = pred.Predictor(settings).predict(class_image)
+    tiled = tiling.predict_tiled(class_image, settings, str(tmp_path / "labels.npy"), tile_size=tile_size, halo=halo)
+    assert np.array_equal(np.array(tiled) > 0, untiled > 0)
+    assert same_objects(np.array(tiled), untiled)
+
+
+def test_tiled_watershed_has_the_same_objects(tmp_path):
+    # The flooding order of the watershed breaks ties, so a few pixels of the watershed lines can move
+    class_image = benchmark.synthetic_class_image(1024, 1024, seed=1)
+    settings = shres.PredictorSettings(predictor="watershed")
+    untiled = pred.Predictor(settings).predict(class_image)
+    tiled = np.array(tiling.predict_tiled(class_image, settings, str(tmp_path / "labels.npy"), tile_size=200,
+                                          halo=32))
+    labelled = (tiled > 0) & (untiled > 0)
+    assert np.count_nonzero((tiled > 0) != (untiled > 0)) < 0.001 * tiled.size
+    assert same_objects(np.where(labelled, tiled, 0), np.where(labelled, untiled, 0))
@@ -0,0 +1,199 @@
+""" Tiled execution of the predictors for class maps that do not fit in memory. The class map is split into tiles
+with a halo of context pixels around them, any predictor registered in predictors.Predictor runs on each tile, and
+the labels of the tile cores are stitched into one globally consistent label image that is written to disk tile by
+tile. Peak memory depends on the tile size, not on the size of the class map.
+
+Class maps stored as .npy files are memory-mapped, so only the tiles being processed are read from disk. PNG class
+maps have to be decoded as a whole by skimage.io.imread.
+"""
+
+import argparse
+import numpy as np
+
+import instrumentation
+import shared_resources as shres
+import predictors as pred
+
+
+def parse_arguments():
+    describe = "Runs a predictor over a large class map tile by tile and writes a stitched label image (.npy)"
+    parser = argparse.ArgumentParser(description=describe)
+    required = parser.add_argument_group("required arguments")
+
+    help_i = "class map to process (.npy of shape HxWx3, or png)"
+    required.add_argument("-i", "--input_file", help=help_i, type=str, required=True)
+
+    help_o = "output .npy file for the label image"
+    required.add_argument("-o", "--output_file", help=help_o, type=str, required=True)
+
+    help_p = "Predictor name"
+    parser.add_argument("-p", "--predictor", help=help_p, type=str, default=shres.DEFAULT_PREDICTOR)
+
+    help_b = "Whether to separate different borders. Type 0 to separate, and 1 to join. Default is to separate"
+    parser.add_argument("-b", "--borders", help=help_b, type=int, default=0, required=False)
+
+    help_c = "Whether to process image using pixel edges or vertices. 0 is vertices, 1 is edges."
+    parser.add_argument("-c", "--connectivity", help=help_c, type=int, default=0, required=False)
+
+    help_pa = "Counts how many passes the pixel_method does."
+    parser.add_argument("-pa", "--passes", help=help_pa, type=int, default=None, required=False)
+
+    help_t = "Size (height = width) of the tiles"
+    parser.add_argument("-t", "--tile_size", help=help_t, type=int, default=1024, required=False)
+
+    help_w = "Width of the halo of context pixels around each tile"
+    parser.add_argument("-w", "--halo", help=help_w, type=int, default=64, required=False)
+    shres.add_trace_argument(parser)
+    args = parser.parse_args()
+    shres.enable_tracing(args.trace_file)
+
+    settings = shres.PredictorSettings(predictor=args.predictor, borders=args.borders,
+                                       connectivity=args.connectivity, passes=args.passes)
+    return {"input_file": args.input_file,
+            "output_file": args.output_file,
+            "settings": settings,
+            "tile_size": args.tile_size,
+            "halo": args.halo}
+
+
+def read_class_map(path):
+    """ Opens a class map without loading it when it is stored as .npy """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode='r')
+    import skimage.io
+    return skimage.io.imread(path)
+
+
+def iterate_tiles(height, width, tile_size):
+    """ Yields the (row, column) slices of the tiles in raster order """
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield slice(y, min(y + tile_size, height)), slice(x, min(x + tile_size, width))
+
+
+class LabelMerger:
+    """ Union-find structure over the global labels. Label 0 is the background and is never merged """
+
+    def __init__(self):
+        self.parents = [0]
+
+    def new_label(self):
+        self.parents.append(len(self.parents))
+        return len(self.parents) - 1
+
+    def find(self, label):
+        root = label
+        while self.parents[root] != root:
+            root = self.parents[root]
+        # Path compression
+        while self.parents[label] != root:
+            self.parents[label], label = root, self.parents[label]
+        return root
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            self.parents[max(first, second)] = min(first, second)
+        return min(first, second)
+
+    def lookup_table(self):
+        """ Maps every global label to a sequential label of its merged object """
+        roots = np.array([self.find(label) for label in range(len(self.parents))], dtype=np.int64)
+        _, sequential = np.unique(roots, return_inverse=True)
+        return sequential.astype(np.int32)
+
+
+def seam_masks(window_rows, window_cols, rows, cols, width):
+    """ Masks of the pixels of a window outside its core (rows, cols) that are within 'width' pixels of the core (the
+    seam) and next to it (the edge of the core)
+    """
+    def distances(window, core):
+        positions = np.arange(window.start, window.stop)
+        return np.maximum(np.maximum(core.start - positions, positions - (core.stop - 1)), 0)
+
+    distance = np.maximum.outer(distances(window_rows, rows), distances(window_cols, cols))
+    return (distance > 0) & (distance <= width), distance == 1
+
+
+def overlaps(local, stitched, mask):
+    """ (local label, global label) pairs of the labelled pixels of 'mask' and their number of pixels, by decreasing
+    number of pixels
+    """
+    both = mask & (local > 0) & (stitched > 0)
+    pairs, counts = np.unique(np.stack([local[both], stitched[both]]), axis=1, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    return pairs[:, order].T.tolist(), counts[order].tolist()
+
+
+def match_labels(local, stitched, merger, seam, edge, min_overlap=0.5):
+    """ Finds, for each local label of a tile, the global label of the same object in the already stitched pixels.
+    Returns a dictionary from local to global labels. A second global label is merged with the best match when the
+    local object covers most of it and the two overlaps are of similar size, since the tile saw them as one object.
+
+    Only the 'seam' next to the core is compared: the outer part of the halo is cut off from the rest of the image,
+    so the tile can label it differently (e.g. give the boundary of a truncated object to its neighbour). An object
+    that continues into the core crosses the seam. Merges are also limited to global objects that reach the 'edge'
+    of the core.
+    """
+    pairs, counts = overlaps(local, stitched, seam)
+    if not pairs:
+        return {}
+    global_labels, global_areas = np.unique(stitched[seam & (stitched > 0)], return_counts=True)
+    area_of = dict(zip(global_labels.tolist(), global_areas.tolist()))
+    at_edge = set(np.unique(stitched[edge]).tolist())
+
+    matches = {}
+    best_counts = {}
+    for (local_label, global_label), count in zip(pairs, counts):
+        if local_label not in matches:
+            # Pairs are visited by decreasing overlap, so the first global label is the best match
+            matches[local_label] = global_label
+            best_counts[local_label] = count
+        elif global_label in at_edge and count >= min_overlap * area_of[global_label] and \
+                count >= min_overlap * best_counts[local_label]:
+            matches[local_label] = merger.union(matches[local_label], global_label)
+    return matches
+
+
+def predict_tiled(class_map, settings, output_file, tile_size=1024, halo=64):
+    """ Runs the predictor in 'settings' over 'class_map' tile by tile and writes the stitched labels (int32) to
+    'output_file'. Returns the memory-mapped label image.
+    """
+    height, width = class_map.shape[:2]
+    labels = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.int32, shape=(height, width))
+    predictor = pred.Predictor(settings)
+    merger = LabelMerger()
+
+    for rows, cols in iterate_tiles(height, width, tile_size):
+        window_rows = slice(max(rows.start - halo, 0), min(rows.stop + halo, height))
+        window_cols = slice(max(cols.start - halo, 0), min(cols.stop + halo, width))
+        with instrumentation.stage("read tile"):
+            window = np.ascontiguousarray(class_map[window_rows, window_cols])
+        local = predictor.predict(window)
+
+        # Tiles are stitched in raster order, so the halo overlaps the cores of the tiles above and to the left.
+        # Pixels of the output that are not stitched yet are still zero and take no part in the matching
+        with instrumentation.stage("stitch"):
+            seam, edge = seam_masks(window_rows, window_cols, rows, cols, max(halo // 2, 1))
+            matches = match_labels(local, labels[window_rows, window_cols], merger, seam, edge)
+
+            core = local[rows.start - window_rows.start:rows.stop - window_rows.start,
+                         cols.start - window_cols.start:cols.stop - window_cols.start]
+            local_labels = np.unique(core)
+            lookup = np.zeros(local.max() + 1, dtype=np.int32)
+            for local_label in local_labels[local_labels > 0].tolist():
+                lookup[local_label] = matches[local_label] if local_label in matches else merger.new_label()
+            labels[rows, cols] = lookup[core]
+
+    # Second pass: replace every global label with the label of its merged object
+    table = merger.lookup_table()
+    for rows, cols in iterate_tiles(height, width, tile_size):
+        labels[rows, cols] = table[labels[rows, cols]]
+    labels.flush()
+    return labels
+
+
+if __name__ == "__main__":
+    OPTIONS = parse_arguments()
+    predict_tiled(read_class_map(OPTIONS["input_file"]), OPTIONS["settings"], OPTIONS["output_file"],
+                  tile_size=OPTIONS["tile_size"], halo=OPTIONS["halo"])